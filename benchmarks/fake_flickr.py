@@ -0,0 +1,268 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# A local stand-in for the parts of the Flickr REST API and the static file
+# hosts that flickr-set-downloader.py uses, with configurable latency,
+# bandwidth and error rate.
+import collections
+import http.server
+import random
+import re
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import quoteattr, escape
+
+
+class FakeAccount:
+    # Every album after the first also contains the first shared_photos photos
+    # of the first album
+    def __init__(self, num_albums, photos_per_album, photo_size, extras=True, shared_photos=0):
+        self.photo_size = photo_size
+        self.extras = extras
+        self.photos = {}
+        self.photosets = []
+        photo_id = 1000000
+        for album_idx in range(num_albums):
+            photo_ids = []
+            for photo_idx in range(photos_per_album):
+                photo_id += 1
+                self.photos[str(photo_id)] = {'title': 'Photo {}'.format(photo_idx),
+                                              'format': 'jpg',
+                                              'lastupdate': 1500000000,
+                                              'dateupload': 1400000000 + photo_id,
+                                              'media': 'photo',
+                                              'width': 4000,
+                                              'height': 3000}
+                photo_ids.append(str(photo_id))
+            if album_idx > 0:
+                photo_ids.extend(self.photosets[0]['photos'][:shared_photos])
+            self.photosets.append({'id': str(72157600000000000 + album_idx),
+                                   'title': 'Album {}'.format(album_idx),
+                                   'date_update': 1500000000,
+                                   'photos': photo_ids})
+
+
+    # Reverse the order of the photos in every step'th album
+    def reorder(self, step=1):
+        for photoset in self.photosets[::step]:
+            photoset['photos'].reverse()
+            photoset['date_update'] += 1
+
+
+    def get_photo_content(self, photo_id):
+        pattern = photo_id.encode('ascii') + b'\n'
+        content = pattern * (self.photo_size // len(pattern) + 1)
+        return content[:self.photo_size]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api_calls = collections.Counter()
+        self.files_served = 0
+        self.bytes_served = 0
+
+
+    def reset(self):
+        with self.lock:
+            self.api_calls.clear()
+            self.files_served = 0
+            self.bytes_served = 0
+
+
+class FakeFlickrHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.startswith('/static/'):
+            self.serve_photo(url.path)
+        else:
+            self.serve_api(urllib.parse.parse_qs(url.query))
+
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        params = urllib.parse.parse_qs(self.path.partition('?')[2])
+        params.update(urllib.parse.parse_qs(body))
+        self.serve_api(params)
+
+
+    def fail_randomly(self):
+        if random.random() < self.server.error_rate:
+            self.send_error(503, 'Service unavailable')
+            return True
+        return False
+
+
+    def serve_api(self, params):
+        params = {key: values[0] for key, values in params.items()}
+        method = params.get('method', '')
+        with self.server.stats.lock:
+            self.server.stats.api_calls[method] += 1
+        time.sleep(self.server.api_latency)
+        if self.fail_randomly():
+            return
+        handler = getattr(self, 'api_' + method.replace('.', '_'), None)
+        if handler is None:
+            body = '<err code="112" msg="Method &quot;{}&quot; not found"/>'.format(escape(method))
+            self.send_xml('<rsp stat="fail">{}</rsp>'.format(body))
+        else:
+            self.send_xml('<rsp stat="ok">{}</rsp>'.format(handler(params)))
+
+
+    def send_xml(self, xml):
+        body = ('<?xml version="1.0" encoding="utf-8" ?>\n' + xml).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    @staticmethod
+    def get_page(params, items):
+        page = int(params.get('page', 1))
+        per_page = int(params.get('per_page', 100))
+        pages = max(1, (len(items) + per_page - 1) // per_page)
+        attrs = 'page="{}" pages="{}" perpage="{}" total="{}"'                      \
+                .format(page, pages, per_page, len(items))
+        return attrs, items[(page - 1) * per_page:page * per_page]
+
+
+    def api_flickr_photosets_getList(self, params):
+        account = self.server.account
+        attrs, photosets = self.get_page(params, account.photosets)
+        elements = ['<photoset id="{}" primary="{}" photos="{}" videos="0" date_update="{}">'
+                    '<title>{}</title><description /></photoset>'
+                    .format(photoset['id'], photoset['photos'][0], len(photoset['photos']),
+                            photoset['date_update'], escape(photoset['title']))
+                    for photoset in photosets]
+        return '<photosets {}>{}</photosets>'.format(attrs, ''.join(elements))
+
+
+    def api_flickr_photosets_getPhotos(self, params):
+        account = self.server.account
+        photoset = next(p for p in account.photosets if p['id'] == params['photoset_id'])
+        attrs, photo_ids = self.get_page(params, photoset['photos'])
+        extras = params.get('extras', '').split(',') if account.extras else []
+        elements = []
+        for photo_id in photo_ids:
+            photo = account.photos[photo_id]
+            element = '<photo id="{}" title={}'.format(photo_id, quoteattr(photo['title']))
+            if 'original_format' in extras:
+                element += ' originalformat="{}"'.format(photo['format'])
+            if 'url_o' in extras:
+                element += ' url_o="{}"'.format(self.get_photo_url(photo_id))
+            if 'last_update' in extras:
+                element += ' lastupdate="{}"'.format(photo['lastupdate'])
+            if 'date_upload' in extras:
+                element += ' dateupload="{}"'.format(photo['dateupload'])
+            if 'media' in extras:
+                element += ' media="{}"'.format(photo['media'])
+            if 'o_dims' in extras:
+                element += ' o_width="{}" o_height="{}"'.format(photo['width'], photo['height'])
+            elements.append(element + ' />')
+        return '<photoset id="{}" {}>{}</photoset>'.format(photoset['id'], attrs,
+                                                          ''.join(elements))
+
+
+    def api_flickr_photos_getInfo(self, params):
+        photo = self.server.account.photos[params['photo_id']]
+        return '<photo id="{}" originalformat="{}" lastupdate="{}"><title>{}</title></photo>'    \
+               .format(params['photo_id'], photo['format'], photo['lastupdate'],
+                       escape(photo['title']))
+
+
+    def api_flickr_photos_recentlyUpdated(self, params):
+        account = self.server.account
+        min_date = int(params['min_date'])
+        photo_ids = [photo_id for photo_id, photo in account.photos.items()
+                     if photo['lastupdate'] >= min_date]
+        attrs, photo_ids = self.get_page(params, photo_ids)
+        elements = ['<photo id="{}" title={} lastupdate="{}" />'
+                    .format(photo_id, quoteattr(account.photos[photo_id]['title']),
+                            account.photos[photo_id]['lastupdate'])
+                    for photo_id in photo_ids]
+        return '<photos {}>{}</photos>'.format(attrs, ''.join(elements))
+
+
+    def api_flickr_photos_getSizes(self, params):
+        return '<sizes><size label="Original" source="{}" /></sizes>'                      \
+               .format(self.get_photo_url(params['photo_id']))
+
+
+    def get_photo_url(self, photo_id):
+        return '{}/static/{}_o.jpg'.format(self.server.url, photo_id)
+
+
+    def serve_photo(self, path):
+        time.sleep(self.server.file_latency)
+        if self.fail_randomly():
+            return
+        match = re.match(r'/static/(\d+)_o\.jpg$', path)
+        if match is None or match.group(1) not in self.server.account.photos:
+            self.send_error(404)
+            return
+        content = self.server.account.get_photo_content(match.group(1))
+        start = 0
+        range_match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if range_match is not None:
+            start = int(range_match.group(1))
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'
+                             .format(start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        body = content[start:]
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write_throttled(body)
+        with self.server.stats.lock:
+            self.server.stats.files_served += 1
+            self.server.stats.bytes_served += len(body)
+
+
+    def write_throttled(self, body, chunk_size=64 * 1024):
+        for offset in range(0, len(body), chunk_size):
+            chunk = body[offset:offset + chunk_size]
+            self.wfile.write(chunk)
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / self.server.bandwidth)
+
+
+class FakeFlickrServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, account, api_latency=0.0, file_latency=0.0, bandwidth=None,
+                 error_rate=0.0):
+        super().__init__(('127.0.0.1', 0), FakeFlickrHandler)
+        self.account = account
+        self.api_latency = api_latency
+        self.file_latency = file_latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.stats = Stats()
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.rest_url = self.url + '/services/rest/'
+
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,174 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Memory benchmark of the photo specs kept during a scan. Scans a synthetic
+# account from photo listings like photosets.getPhotos returns, putting every
+# album in the album cache as download() does, and reports the peak RSS it
+# took. The compact column representation is compared with one object per
+# photo, as the specs were kept before.
+#
+#   python benchmarks/memory_benchmark.py --photos 1000000
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+
+_dirname = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _dirname)
+
+from run_benchmark import load_downloader
+
+
+# A photo spec as one object with a __dict__ per photo, holding on to the API
+# client, the way photos were kept before they were stored in columns
+class ObjectPhotoDownloadSpec:
+    def __init__(self, flickr, name, identifier, filetype, url=None, lastupdate=None,
+                 media=None, pixels=None, dateupload=None, url_cache=None):
+        self._flickr = flickr
+        self._url_cache = url_cache
+        self.name = name
+        self.identifier = identifier
+        self.filetype = filetype
+        self.url = url
+        self.lastupdate = lastupdate
+        self.media = media
+        self.pixels = pixels
+        self.dateupload = dateupload
+
+
+def get_photosets(num_photos, photos_per_album):
+    photo_id = 50000000000
+    for album_idx in range((num_photos + photos_per_album - 1) // photos_per_album):
+        photoset = ElementTree.Element('photoset', {
+            'id': str(72157600000000000 + album_idx), 'date_update': '1500000000',
+            'photos': str(photos_per_album), 'videos': '0'})
+        ElementTree.SubElement(photoset, 'title').text = 'Album {}'.format(album_idx)
+        photos = []
+        for photo_idx in range(min(photos_per_album, num_photos - album_idx * photos_per_album)):
+            photo_id += 1
+            photos.append(ElementTree.Element('photo', {
+                'id': str(photo_id), 'title': 'IMG_{:04d}'.format(photo_idx),
+                'originalformat': 'jpg', 'lastupdate': str(1500000000 + photo_idx),
+                'url_o': 'https://live.staticflickr.com/65535/{}_{:010x}_o.jpg'
+                         .format(photo_id, photo_id * 7919 % 16 ** 10),
+                'media': 'photo', 'o_width': '6000', 'o_height': '4000',
+                'dateupload': str(1400000000 + photo_idx)}))
+        yield photoset, photos
+
+
+def scan_compact(downloader, album_cache, photoset, photos):
+    album_spec = downloader.AlbumDownloadSpec(photoset.find('title').text, photoset.get('id'))
+    for photo in photos:
+        album_spec.photos.append(downloader.get_photo_spec(None, photo))
+    album_cache.put(photoset, album_spec)
+    return album_spec
+
+
+OBJECT_ALBUM_CACHE = {}
+
+
+def scan_objects(downloader, album_cache, photoset, photos):
+    album_spec = downloader.AlbumDownloadSpec(photoset.find('title').text, photoset.get('id'))
+    album_spec.photos = []
+    flickr = object()
+    for photo in photos:
+        spec = downloader.get_photo_spec(None, photo)
+        album_spec.photos.append(ObjectPhotoDownloadSpec(
+            flickr, photo.get('title'), photo.get('id'), spec.filetype, photo.get('url_o'),
+            photo.get('lastupdate'), spec.media, spec.pixels, spec.dateupload))
+    # The album cache kept a tuple of the fields of each photo, in memory
+    OBJECT_ALBUM_CACHE[album_spec.identifier] = (album_cache.get_key(photoset), [
+        (photo.name, photo.identifier, photo.filetype, photo.url, photo.lastupdate,
+         photo.media, photo.pixels, photo.dateupload) for photo in album_spec.photos])
+    return album_spec
+
+
+SCANNERS = {'compact': scan_compact, 'objects': scan_objects}
+
+
+def get_max_rss():
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+# Runs in a process of its own, so that the peak RSS is that of one variant
+def run_variant(variant, args):
+    downloader = load_downloader()
+    album_cache = downloader.AlbumSpecCache(tempfile.mkdtemp())
+    if args.tracemalloc:
+        tracemalloc.start()
+    baseline = get_max_rss()
+    start = time.monotonic()
+    album_specs = []
+    for photoset, photos in get_photosets(args.photos, args.photos_per_album):
+        album_specs.append(SCANNERS[variant](downloader, album_cache, photoset, photos))
+    result = {'variant': variant,
+              'photos': args.photos,
+              'seconds': time.monotonic() - start,
+              'peak_rss': get_max_rss() - baseline}
+    if args.tracemalloc:
+        result['traced'], result['traced_peak'] = tracemalloc.get_traced_memory()
+    return result
+
+
+def print_results(results):
+    print('')
+    print('{:<10} {:>10} {:>10} {:>14} {:>14}'
+          .format('variant', 'photos', 'time [s]', 'peak RSS [MiB]', 'bytes/photo'))
+    for result in results:
+        print('{variant:<10} {photos:>10} {seconds:>10.1f} {0:>14.1f} {1:>14.0f}'
+              .format(result['peak_rss'] / 1024 ** 2, result['peak_rss'] / result['photos'],
+                      **result))
+        if 'traced' in result:
+            print('{:<10} {:>50}'.format('', 'traced {:.1f} MiB, {:.1f} MiB at peak'
+                                         .format(result['traced'] / 1024 ** 2,
+                                                 result['traced_peak'] / 1024 ** 2)))
+    if len(results) == 2:
+        print('')
+        print('objects / compact: {:.1f}x'
+              .format(results[1]['peak_rss'] / max(results[0]['peak_rss'], 1)))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the memory used by the photo specs '
+                                                 'of a large account')
+    parser.add_argument('--photos', type=int, default=1000000)
+    parser.add_argument('--photos-per-album', type=int, default=500)
+    parser.add_argument('--variant', choices=sorted(SCANNERS),
+                        help='Only run this variant, in this process')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Also report the memory traced by tracemalloc, which is slow')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.variant is not None:
+        print(json.dumps(run_variant(args.variant, args)))
+        return
+
+    results = []
+    for variant in ['compact', 'objects']:
+        command = [sys.executable, os.path.abspath(__file__), '--variant', variant,
+                   '--photos', str(args.photos), '--photos-per-album', str(args.photos_per_album)]
+        if args.tracemalloc:
+            command.append('--tracemalloc')
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# End-to-end benchmark of download() against a local fake Flickr. Runs a cold
+# sync into an empty directory, a no-op resync and a resync after albums have
+# been reordered, and reports throughput and API usage for each.
+#
+#   python benchmarks/run_benchmark.py --albums 20 --photos-per-album 100 --jobs 8
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+_dirname = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_dirname, '..'))
+sys.path.insert(0, _dirname)
+import flickrapi
+
+import fake_flickr
+
+
+def load_downloader():
+    path = os.path.join(_dirname, '..', 'flickr-set-downloader.py')
+    spec = importlib.util.spec_from_file_location('flickr_set_downloader', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_scenario(name, downloader, server, working_directory, args):
+    server.stats.reset()
+    config = {'username': 'benchmark', 'api_key': 'key', 'api_secret': 'secret'}
+    start = time.monotonic()
+    downloader.download(working_directory, config, jobs=args.jobs, scan_jobs=args.scan_jobs,
+                        api_calls_per_hour=args.api_rate, max_jobs=args.max_jobs,
+                        max_api_jobs=args.max_api_jobs)
+    wall_time = time.monotonic() - start
+
+    num_photos = len(server.account.photos)
+    api_calls = sum(server.stats.api_calls.values())
+    return {'scenario': name,
+            'wall_time': wall_time,
+            'photos_downloaded': server.stats.files_served,
+            'bytes_downloaded': server.stats.bytes_served,
+            'photos_per_sec': server.stats.files_served / wall_time,
+            'api_calls': api_calls,
+            'api_calls_per_photo': api_calls / num_photos,
+            'api_calls_by_method': dict(server.stats.api_calls)}
+
+
+def print_results(results):
+    print('')
+    print('{:<10} {:>10} {:>10} {:>12} {:>10} {:>14}'
+          .format('scenario', 'wall [s]', 'photos', 'photos/s', 'api calls', 'calls/photo'))
+    for result in results:
+        print('{scenario:<10} {wall_time:>10.2f} {photos_downloaded:>10} {photos_per_sec:>12.1f} '
+              '{api_calls:>10} {api_calls_per_photo:>14.2f}'.format(**result))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark flickr-set-downloader against a '
+                                                 'local fake Flickr')
+    parser.add_argument('--albums', type=int, default=10)
+    parser.add_argument('--photos-per-album', type=int, default=50)
+    parser.add_argument('--photo-size', type=int, default=256 * 1024, metavar='BYTES')
+    parser.add_argument('--api-latency', type=float, default=0.05, metavar='SECONDS')
+    parser.add_argument('--file-latency', type=float, default=0.05, metavar='SECONDS')
+    parser.add_argument('--bandwidth', type=float, default=None, metavar='BYTES_PER_SEC',
+                        help='Bandwidth of each file download (default: unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests that fail with 503')
+    parser.add_argument('--no-extras', action='store_true',
+                        help='Leave out photo extras from photosets.getPhotos')
+    parser.add_argument('--shared-photos', type=int, default=0, metavar='N',
+                        help='Also put the first N photos of the first album in every other album')
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--scan-jobs', type=int, default=4)
+    parser.add_argument('--max-jobs', type=int, metavar='N',
+                        help='Adapt the number of concurrent downloads up to N')
+    parser.add_argument('--max-api-jobs', type=int, metavar='N',
+                        help='Adapt the number of concurrent API calls up to N')
+    parser.add_argument('--api-rate', type=int, default=10 ** 9, metavar='CALLS',
+                        help='API calls per hour allowed by the downloader')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    account = fake_flickr.FakeAccount(args.albums, args.photos_per_album, args.photo_size,
+                                      extras=not args.no_extras,
+                                      shared_photos=args.shared_photos)
+    server = fake_flickr.FakeFlickrServer(account, api_latency=args.api_latency,
+                                          file_latency=args.file_latency,
+                                          bandwidth=args.bandwidth,
+                                          error_rate=args.error_rate).start()
+    flickrapi.FlickrAPI.REST_URL = server.rest_url
+    downloader = load_downloader()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as working_directory:
+            results.append(run_scenario('cold', downloader, server, working_directory, args))
+            results.append(run_scenario('noop', downloader, server, working_directory, args))
+            account.reorder(step=2)
+            results.append(run_scenario('reorder', downloader, server, working_directory, args))
+    finally:
+        server.stop()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
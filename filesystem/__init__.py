@@ -1,9 +1,12 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
-from .filesystem import Filesystem, FilesystemOperations
+from .filesystem import Filesystem, FilesystemOperations, FileInfo, FileSpec, STATE_BACKENDS
 
 __all__ = [
     Filesystem,
-    FilesystemOperations
+    FilesystemOperations,
+    FileInfo,
+    FileSpec,
+    STATE_BACKENDS
 ]
\ No newline at end of file
@@ -1,32 +1,71 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import collections
+import concurrent.futures
+import hashlib
+import json
 import os
 import pickle
+import sqlite3
 import uuid
 
 FSYS_STATE_FILENAME = './filesystem-state.pickle'
+FSYS_JOURNAL_FILENAME = './filesystem-state.journal'
+FSYS_DATABASE_FILENAME = './filesystem-state.sqlite'
+PARTIAL_SUFFIX = '.part'
+
+
+# Several states can be kept in the same directory, one for each partition
+# of the files. Their files are named after the partition.
+def get_state_path(dirname, filename, partition=None):
+    if partition is not None:
+        root, ext = os.path.splitext(filename)
+        filename = '{}.{}{}'.format(root, partition, ext)
+    return os.path.join(dirname, filename)
 
 
 class FilesystemState:
-    def __init__(self, dirname):
-        path = os.path.join(dirname, FSYS_STATE_FILENAME)
-        if os.path.exists(path):
-            data = pickle.load(open(path, 'rb'))
-            self.filenames = data['filenames']
-            self.identifiers = data['identifiers']
+    def __init__(self, dirname, partition=None):
+        self.path = get_state_path(dirname, FSYS_STATE_FILENAME, partition)
+        if os.path.exists(self.path):
+            data = pickle.load(open(self.path, 'rb'))
         else:
-            self.filenames = {}
-            self.identifiers = {}
+            data = {'filenames': {}, 'identifiers': {}}
+        self.load(data)
         self.dirname = dirname
+        self.partition = partition
         self.clear_temporary_filenames()
         self.clear_touched_filenames()
 
 
+    def load(self, data):
+        self.filenames = data['filenames']
+        self.identifiers = data['identifiers']
+        self.partials = data.get('partials', {})
+        self.infos = data.get('infos', {})
+        self.contents = data.get('contents', {})
+        self.content_sources = collections.defaultdict(set)
+        for identifier, content_id in self.contents.items():
+            self.content_sources[content_id].add(identifier)
+
+
+    def dump(self):
+        return {'filenames': self.filenames, 'identifiers': self.identifiers,
+                'partials': self.partials, 'contents': self.contents, 'infos': self.infos}
+
+
     def save(self):
-        path = os.path.join(self.dirname, FSYS_STATE_FILENAME)
-        data = {'filenames': self.filenames, 'identifiers': self.identifiers}
-        pickle.dump(data, open(path, 'wb'))
+        pickle.dump(self.dump(), open(self.path, 'wb'))
+
+
+    def close(self):
+        pass
+
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
 
 
     def add(self, identifier, filename, temporary=False):
@@ -45,6 +84,26 @@ class FilesystemState:
             self.temporary_filenames.add(filename)
 
 
+    # Give a file a new filename, keeping everything else that is known about it
+    def move(self, identifier, filename, temporary=False):
+        if not self.has_identifier(identifier):
+            raise RuntimeError('Cannot move <{}, {}> - identifier doesn\'t exists'
+                                .format(identifier, filename))
+        if self.has_filename(filename):
+            raise RuntimeError('Cannot move <{}, {}> - filename already exists'
+                                .format(identifier, filename))
+        old_filename = self.filenames[identifier]
+        self.identifiers.pop(old_filename)
+        self.touched_filenames.discard(old_filename)
+        self.temporary_filenames.discard(old_filename)
+        self.filenames[identifier] = filename
+        self.identifiers[filename] = identifier
+        if not temporary:
+            self.touched_filenames.add(filename)
+        else:
+            self.temporary_filenames.add(filename)
+
+
     def touch(self, identifier, filename):
         if not self.has_identifier(identifier):
             raise RuntimeError('Cannot touch <{}, {}> - identifier doesn\'t exists'
@@ -62,6 +121,9 @@ class FilesystemState:
         self.identifiers.pop(filename)
         self.filenames.pop(identifier)
         self.touched_filenames.discard(filename)
+        self.temporary_filenames.discard(filename)
+        self.discard_content(identifier)
+        self.infos.pop(identifier, None)
 
 
     def remove_filename(self, filename):
@@ -71,6 +133,9 @@ class FilesystemState:
         self.identifiers.pop(filename)
         self.filenames.pop(identifier)
         self.touched_filenames.discard(filename)
+        self.temporary_filenames.discard(filename)
+        self.discard_content(identifier)
+        self.infos.pop(identifier, None)
 
 
     def get_identifier(self, filename):
@@ -89,10 +154,72 @@ class FilesystemState:
         return filename in self.identifiers.keys()
 
 
+    def get_files(self):
+        return list(self.filenames.items())
+
+
     def has_identifier(self, identifier):
         return identifier in self.filenames.keys()
 
 
+    # Partial files are downloads that haven't completed yet. They are kept
+    # between runs so that the download can be resumed.
+    def add_partial(self, identifier, filename):
+        self.partials[identifier] = filename
+
+
+    def remove_partial(self, identifier):
+        self.partials.pop(identifier, None)
+
+
+    def get_partial(self, identifier):
+        return self.partials.get(identifier)
+
+
+    def get_partials(self):
+        return dict(self.partials)
+
+
+    # Files with the same content id have the same content, e.g. the same photo
+    # in different albums. Only completed files should be given a content id.
+    def set_content(self, identifier, content_id):
+        if not self.has_identifier(identifier):
+            raise RuntimeError('No such identifier: {}'.format(identifier))
+        self.discard_content(identifier)
+        self.contents[identifier] = content_id
+        self.content_sources[content_id].add(identifier)
+
+
+    def discard_content(self, identifier):
+        content_id = self.contents.pop(identifier, None)
+        if content_id is not None:
+            self.content_sources[content_id].discard(identifier)
+            if not self.content_sources[content_id]:
+                self.content_sources.pop(content_id)
+
+
+    def get_content(self, identifier):
+        return self.contents.get(identifier)
+
+
+    # Returns the identifier of a file with the given content, if there is one
+    def get_content_source(self, content_id):
+        identifiers = self.content_sources.get(content_id)
+        return next(iter(identifiers)) if identifiers else None
+
+
+    def set_info(self, identifier, info):
+        if not self.has_identifier(identifier):
+            raise RuntimeError('No such identifier: {}'.format(identifier))
+        self.infos[identifier] = tuple(info)
+
+
+    # Size and digest of a completed file, if known
+    def get_info(self, identifier):
+        info = self.infos.get(identifier)
+        return FileInfo(*info) if info is not None else None
+
+
     def get_untouched_filenames(self):
         filenames = set(self.filenames.values())
         return filenames.difference(self.touched_filenames)
@@ -106,54 +233,727 @@ class FilesystemState:
         self.temporary_filenames = set()
 
 
+# Records every change to the state in an append-only journal, so that nothing
+# is lost if the process dies before save() is called. The journal is folded
+# into the pickled snapshot on save() and whenever it grows too large.
+#
+# The snapshot and the journal both carry a generation number. A journal whose
+# generation doesn't match the snapshot has already been folded into it.
+class JournaledFilesystemState(FilesystemState):
+    SYNC_INTERVAL = 100
+    COMPACT_INTERVAL = 100000
+
+    def __init__(self, dirname, partition=None):
+        self.journal = None
+        super().__init__(dirname, partition)
+        self.journal_path = get_state_path(dirname, FSYS_JOURNAL_FILENAME, partition)
+        self.replay()
+        self.clear_touched_filenames()
+        self.compact()
+
+
+    def load(self, data):
+        super().load(data)
+        self.generation = data.get('generation', 0)
+
+
+    def dump(self):
+        data = super().dump()
+        data['generation'] = self.generation
+        return data
+
+
+    def replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path) as f:
+            for idx, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last record was cut short by a crash
+                    break
+                if idx == 0:
+                    if record != ['generation', self.generation]:
+                        break
+                    continue
+                operation, args = record[0], record[1:]
+                if operation == 'add':
+                    self.add(*args)
+                elif operation == 'remove':
+                    self.remove_identifier(*args)
+                elif operation == 'add_partial':
+                    self.add_partial(*args)
+                elif operation == 'remove_partial':
+                    self.remove_partial(*args)
+                elif operation == 'move':
+                    self.move(*args)
+                elif operation == 'set_content':
+                    self.set_content(*args)
+                elif operation == 'set_info':
+                    self.set_info(*args)
+
+
+    def record(self, *record):
+        if self.journal is None:
+            return
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        self.num_records += 1
+        if self.num_records % self.SYNC_INTERVAL == 0:
+            os.fsync(self.journal.fileno())
+        if self.num_records >= self.COMPACT_INTERVAL:
+            self.compact()
+
+
+    def compact(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.generation += 1
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(self.dump(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        self.journal = open(self.journal_path, 'w')
+        self.num_records = 0
+        self.journal.write(json.dumps(['generation', self.generation]) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+
+    def save(self):
+        self.compact()
+
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+    def delete(self):
+        self.close()
+        super().delete()
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+
+
+    def add(self, identifier, filename, temporary=False):
+        super().add(identifier, filename, temporary=temporary)
+        self.record('add', identifier, filename)
+
+
+    def remove_identifier(self, identifier):
+        super().remove_identifier(identifier)
+        self.record('remove', identifier)
+
+
+    def remove_filename(self, filename):
+        identifier = self.get_identifier(filename)
+        super().remove_filename(filename)
+        self.record('remove', identifier)
+
+
+    def add_partial(self, identifier, filename):
+        super().add_partial(identifier, filename)
+        self.record('add_partial', identifier, filename)
+
+
+    def remove_partial(self, identifier):
+        if self.get_partial(identifier) is not None:
+            super().remove_partial(identifier)
+            self.record('remove_partial', identifier)
+
+
+    def move(self, identifier, filename, temporary=False):
+        super().move(identifier, filename, temporary=temporary)
+        self.record('move', identifier, filename)
+
+
+    def set_content(self, identifier, content_id):
+        super().set_content(identifier, content_id)
+        self.record('set_content', identifier, content_id)
+
+
+    def set_info(self, identifier, info):
+        super().set_info(identifier, info)
+        self.record('set_info', identifier, list(info))
+
+
+# Keeps the state in an indexed SQLite table instead of in memory, so that
+# startup doesn't have to load every entry and lookups stay cheap for very
+# large accounts. An existing pickled state is imported on first use.
+class SqliteFilesystemState:
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, dirname, partition=None):
+        self.dirname = dirname
+        self.partition = partition
+        self.path = get_state_path(dirname, FSYS_DATABASE_FILENAME, partition)
+        is_new = not os.path.exists(self.path)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                identifier TEXT PRIMARY KEY,
+                filename TEXT NOT NULL UNIQUE,
+                touched INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS files_touched ON files (touched);
+            CREATE TABLE IF NOT EXISTS partials (
+                identifier TEXT PRIMARY KEY,
+                filename TEXT NOT NULL
+            );
+        ''')
+        self.add_column('content_id', 'TEXT')
+        self.add_column('size', 'INTEGER')
+        self.add_column('digest', 'TEXT')
+        self.add_column('mtime', 'REAL')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_content_id ON files (content_id)')
+        self.num_changes = 0
+        if is_new and os.path.exists(get_state_path(dirname, FSYS_STATE_FILENAME, partition)):
+            self.import_state(FilesystemState(dirname, partition))
+        self.clear_temporary_filenames()
+        self.clear_touched_filenames()
+
+
+    # Add a column to the files table of a database created by an older version
+    def add_column(self, name, definition):
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+        if name not in columns:
+            self.db.execute('ALTER TABLE files ADD COLUMN {} {}'.format(name, definition))
+
+
+    def import_state(self, state):
+        self.db.executemany('INSERT INTO files (identifier, filename, content_id) VALUES (?, ?, ?)',
+                            ((identifier, filename, state.get_content(identifier))
+                             for identifier, filename in state.filenames.items()))
+        for identifier in state.infos:
+            self.set_info(identifier, state.get_info(identifier))
+        self.db.executemany('INSERT INTO partials (identifier, filename) VALUES (?, ?)',
+                            state.partials.items())
+        self.db.commit()
+
+
+    def save(self):
+        self.db.commit()
+        self.num_changes = 0
+
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+    def delete(self):
+        self.db.close()
+        os.unlink(self.path)
+
+
+    def changed(self):
+        self.num_changes += 1
+        if self.num_changes >= self.COMMIT_INTERVAL:
+            self.save()
+
+
+    def add(self, identifier, filename, temporary=False):
+        if self.has_identifier(identifier):
+            raise RuntimeError('Cannot add <{}, {}> - identifier already exists'
+                                .format(identifier, filename))
+        if self.has_filename(filename):
+            raise RuntimeError('Cannot add <{}, {}> - filename already exists'
+                                .format(identifier, filename))
+
+        self.db.execute('INSERT INTO files (identifier, filename, touched) VALUES (?, ?, ?)',
+                        (identifier, filename, 0 if temporary else 1))
+        if temporary:
+            self.temporary_filenames.add(filename)
+        self.changed()
+
+
+    def touch(self, identifier, filename):
+        if not self.has_identifier(identifier):
+            raise RuntimeError('Cannot touch <{}, {}> - identifier doesn\'t exists'
+                                .format(identifier, filename))
+        if not self.has_filename(filename):
+            raise RuntimeError('Cannot touch <{}, {}> - filename doesn\'t exists'
+                                .format(identifier, filename))
+        self.db.execute('UPDATE files SET touched = 1 WHERE filename = ?', (filename,))
+        self.changed()
+
+
+    def move(self, identifier, filename, temporary=False):
+        if not self.has_identifier(identifier):
+            raise RuntimeError('Cannot move <{}, {}> - identifier doesn\'t exists'
+                                .format(identifier, filename))
+        if self.has_filename(filename):
+            raise RuntimeError('Cannot move <{}, {}> - filename already exists'
+                                .format(identifier, filename))
+        self.temporary_filenames.discard(self.get_filename(identifier))
+        self.db.execute('UPDATE files SET filename = ?, touched = ? WHERE identifier = ?',
+                        (filename, 0 if temporary else 1, identifier))
+        if temporary:
+            self.temporary_filenames.add(filename)
+        self.changed()
+
+
+    def remove_identifier(self, identifier):
+        self.temporary_filenames.discard(self.get_filename(identifier))
+        self.db.execute('DELETE FROM files WHERE identifier = ?', (identifier,))
+        self.changed()
+
+
+    def remove_filename(self, filename):
+        if not self.has_filename(filename):
+            raise RuntimeError('No such filename: {}'.format(filename))
+        self.temporary_filenames.discard(filename)
+        self.db.execute('DELETE FROM files WHERE filename = ?', (filename,))
+        self.changed()
+
+
+    def get_identifier(self, filename):
+        row = self.db.execute('SELECT identifier FROM files WHERE filename = ?',
+                              (filename,)).fetchone()
+        if row is None:
+            raise RuntimeError('No such filename: {}'.format(filename))
+        return row[0]
+
+
+    def get_filename(self, identifier):
+        row = self.db.execute('SELECT filename FROM files WHERE identifier = ?',
+                              (identifier,)).fetchone()
+        if row is None:
+            raise RuntimeError('No such identifier: {}'.format(identifier))
+        return row[0]
+
+
+    def has_filename(self, filename):
+        return self.db.execute('SELECT 1 FROM files WHERE filename = ?',
+                               (filename,)).fetchone() is not None
+
+
+    def has_identifier(self, identifier):
+        return self.db.execute('SELECT 1 FROM files WHERE identifier = ?',
+                               (identifier,)).fetchone() is not None
+
+
+    def get_files(self):
+        return self.db.execute('SELECT identifier, filename FROM files').fetchall()
+
+
+    def add_partial(self, identifier, filename):
+        self.db.execute('INSERT OR REPLACE INTO partials (identifier, filename) VALUES (?, ?)',
+                        (identifier, filename))
+        self.changed()
+
+
+    def remove_partial(self, identifier):
+        self.db.execute('DELETE FROM partials WHERE identifier = ?', (identifier,))
+        self.changed()
+
+
+    def get_partial(self, identifier):
+        row = self.db.execute('SELECT filename FROM partials WHERE identifier = ?',
+                              (identifier,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def get_partials(self):
+        return dict(self.db.execute('SELECT identifier, filename FROM partials'))
+
+
+    def set_content(self, identifier, content_id):
+        if not self.has_identifier(identifier):
+            raise RuntimeError('No such identifier: {}'.format(identifier))
+        self.db.execute('UPDATE files SET content_id = ? WHERE identifier = ?',
+                        (content_id, identifier))
+        self.changed()
+
+
+    def get_content(self, identifier):
+        row = self.db.execute('SELECT content_id FROM files WHERE identifier = ?',
+                              (identifier,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def get_content_source(self, content_id):
+        row = self.db.execute('SELECT identifier FROM files WHERE content_id = ? LIMIT 1',
+                              (content_id,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def set_info(self, identifier, info):
+        if not self.has_identifier(identifier):
+            raise RuntimeError('No such identifier: {}'.format(identifier))
+        info = FileInfo(*info)
+        self.db.execute('UPDATE files SET size = ?, digest = ?, mtime = ? WHERE identifier = ?',
+                        (info.size, info.digest, info.mtime, identifier))
+        self.changed()
+
+
+    def get_info(self, identifier):
+        row = self.db.execute('SELECT size, digest, mtime FROM files WHERE identifier = ?',
+                              (identifier,)).fetchone()
+        return FileInfo(*row) if row is not None and row[0] is not None else None
+
+
+    def get_untouched_filenames(self):
+        rows = self.db.execute('SELECT filename FROM files WHERE touched = 0')
+        return set(row[0] for row in rows)
+
+
+    def clear_touched_filenames(self):
+        self.db.execute('UPDATE files SET touched = 0 WHERE touched = 1')
+        self.changed()
+
+
+    def clear_temporary_filenames(self):
+        self.temporary_filenames = set()
+
+
+STATE_BACKENDS = {
+    'pickle': FilesystemState,
+    'journal': JournaledFilesystemState,
+    'sqlite': SqliteFilesystemState,
+}
+
+
+# Creators may return a FileInfo for the file they created, which is then kept
+# in the state. The digest is the hex SHA-256 digest of the file.
+FileInfo = collections.namedtuple('FileInfo', ['size', 'digest', 'mtime'], defaults=[None])
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# A file to add with Filesystem.add_many
+FileSpec = collections.namedtuple('FileSpec', ['identifier', 'filename', 'creator', 'content_id'],
+                                  defaults=[None])
+
+
+def get_temporary_filename():
+    return str(uuid.uuid4())
+
+
+# Order the renames in moves, a dict of old filename -> new filename, so that
+# no file is overwritten. Chains of renames are done back to front. Each cycle
+# is broken by moving one of its files to a temporary name first. Returns a
+# list of (old filename, new filename) pairs.
+def plan_renames(moves, get_temporary_filename=get_temporary_filename):
+    plan = []
+    sources = {new_filename: old_filename for old_filename, new_filename in moves.items()}
+    remaining = dict(moves)
+
+    def unwind(filename):
+        # Fill the now free filename with the file that should go there, and so on
+        while filename in sources and sources[filename] in remaining:
+            old_filename = sources[filename]
+            plan.append((old_filename, filename))
+            del remaining[old_filename]
+            filename = old_filename
+
+    # Chains end in a filename that isn't being moved away
+    for new_filename in moves.values():
+        if new_filename not in moves:
+            unwind(new_filename)
+    # Whatever is left are cycles
+    while remaining:
+        old_filename, new_filename = next(iter(remaining.items()))
+        temporary_filename = get_temporary_filename()
+        plan.append((old_filename, temporary_filename))
+        del remaining[old_filename]
+        unwind(old_filename)
+        plan.append((temporary_filename, new_filename))
+    return plan
+
+
+# Linux ioctl for cloning a file on copy-on-write filesystems like Btrfs and XFS
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.unlink(dst)
+            raise
+
+
+# Make dst share its content with src. Raises OSError if the filesystem
+# supports neither hardlinks nor reflinks between the two paths.
+def link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            reflink(src, dst)
+        except ImportError:
+            raise OSError('Cannot link {} to {}'.format(dst, src))
+
+
+# Returns a dict of the entries in a directory, keyed by name. A directory
+# that doesn't exist is empty.
+def list_directory(path):
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries}
+    except FileNotFoundError:
+        return {}
+
+
 class FilesystemOperations:
     def __init__(self):
         self.exists = os.path.exists
+        self.list_directory = list_directory
         self.mkdir = os.mkdir
         self.rename = os.rename
         self.delete = os.unlink
+        self.link = link_file
+        self.stat = os.stat
+        self.hash = hash_file
 
 
 class Filesystem:
-    def __init__(self, dirname, fsops=None):
+    # If an executor is given, creators run on it and only the state bookkeeping
+    # happens in the calling thread. At most max_pending creators are in flight.
+    def __init__(self, dirname, fsops=None, executor=None, max_pending=None,
+                 backend='pickle', partition=None):
         self.dirname = dirname
         self.fsops = fsops or FilesystemOperations()
         if not self.fsops.exists(dirname):
             self.fsops.mkdir(dirname)
-        self.state = FilesystemState(dirname)
+        self.state = STATE_BACKENDS[backend](dirname, partition)
+        self.executor = executor
+        self.max_pending = max_pending
+        self.pending = {}
+        # Futures of pending creators, by identifier
+        self.pending_identifiers = {}
+        # Copies waiting for a pending creator of the same content, by content id
+        self.pending_contents = {}
+        # Directory listings taken during the current sync
+        self.listings = {}
+        # Number of files created, linked, moved and deleted
+        self.counters = collections.Counter()
 
 
-    def add(self, identifier, filename, creator):
-        path = os.path.join(self.dirname, filename)
+    # Files added with the same content_id are only created once. Other copies
+    # are hardlinked (or reflinked) to the first one where the filesystem allows it.
+    def add(self, identifier, filename, creator, content_id=None):
         if self.state.has_identifier(identifier):
             # Identifier already exists. Move file to temporary filename
-            if not self.fsops.exists(path):
+            path = os.path.join(self.dirname, self.state.get_filename(identifier))
+            if not self.file_exists(path):
                 # File has been deleted since last run, download again
                 self.state.remove_identifier(identifier)
-                self.create(identifier, filename, creator)
+                self.create(identifier, filename, creator, content_id)
             else:
+                if content_id is not None:
+                    self.state.set_content(identifier, content_id)
                 self.move(identifier, filename)
         elif self.state.has_filename(filename):
             # Filename already exists, but not identifier.
             # Give file temporary name and create the new file
             other_identifier = self.state.get_identifier(filename)
             self.move_temporary(other_identifier)
-            self.create(identifier, filename, creator)
+            self.create(identifier, filename, creator, content_id)
         else:
             # Neither filename nor identifier exists. Create file
-            self.create(identifier, filename, creator)
+            self.create(identifier, filename, creator, content_id)
+
+
+    # Files are looked up in a listing of their directory, taken the first time
+    # the directory is looked at during a sync, rather than checked one by one.
+    # The listing is kept up to date as files are created, moved and deleted.
+    # Entries for files that changed during the sync are None.
+    def get_listing(self, dirname):
+        listing = self.listings.get(dirname)
+        if listing is None:
+            listing = self.listings[dirname] = self.fsops.list_directory(dirname)
+        return listing
+
+
+    def file_exists(self, path):
+        dirname, name = os.path.split(path)
+        return name in self.get_listing(dirname)
+
+
+    def stat_file(self, path):
+        dirname, name = os.path.split(path)
+        listing = self.get_listing(dirname)
+        if name not in listing:
+            raise FileNotFoundError('No such file: {}'.format(path))
+        entry = listing[name]
+        if entry is None:
+            return self.fsops.stat(path)
+        return entry.stat()
+
+
+    # A sync that failed may have left listings that no longer match the
+    # directories, so the next sync lists them again
+    def abort_sync(self):
+        self.listings.clear()
 
 
-    def create(self, identifier, filename, creator):
+    def listing_added(self, path):
+        dirname, name = os.path.split(path)
+        self.get_listing(dirname)[name] = None
+
+
+    def listing_removed(self, path):
+        dirname, name = os.path.split(path)
+        if dirname in self.listings:
+            self.listings[dirname].pop(name, None)
+
+
+    # Creators may write to get_partial_path(identifier, filename) and rename it
+    # to path when done. The partial file is kept if creation fails.
+    def get_partial_path(self, identifier, filename):
+        return os.path.join(self.dirname, self.get_partial_filename(identifier, filename))
+
+
+    @staticmethod
+    def get_partial_filename(identifier, filename):
+        return os.path.join(os.path.dirname(filename),
+                            '.{}{}'.format(identifier, PARTIAL_SUFFIX))
+
+
+    # A copy of content that is still being created waits for its creator to
+    # finish, and is then linked to it. If the creator fails, the copy is
+    # created with its own creator instead.
+    def create(self, identifier, filename, creator, content_id=None):
         path = os.path.join(self.dirname, filename)
+        if content_id is not None:
+            if content_id in self.pending_contents:
+                self.pending_contents[content_id].append((identifier, filename, creator))
+                return
+            if self.link(identifier, filename, content_id):
+                return
+        self.track_partial(identifier, filename)
         self.state.add(identifier, filename)
+        self.listing_added(path)
+        if self.executor is not None:
+            future = self.executor.submit(creator, path)
+            self.pending[future] = (identifier, path, content_id)
+            self.pending_identifiers[identifier] = future
+            if content_id is not None:
+                self.pending_contents[content_id] = []
+            if self.max_pending and len(self.pending) >= self.max_pending:
+                self.wait_pending(return_when=concurrent.futures.FIRST_COMPLETED)
+            return
         try:
-            creator(path)
+            info = creator(path)
         except Exception as e:
             # File is probably incomplete if exception is raised during creation
-            self.state.remove_identifier(identifier)
-            self.fsops.delete(path)
+            self.creation_failed(identifier, path)
             raise e
+        self.creation_completed(identifier, content_id, info)
+
+
+    def creation_completed(self, identifier, content_id, info):
+        self.state.remove_partial(identifier)
+        if content_id is not None:
+            self.state.set_content(identifier, content_id)
+        if info is not None:
+            self.state.set_info(identifier, info)
+        self.counters['created'] += 1
+
+
+    # Create the file by linking it to an existing file with the same content.
+    # Returns False if there is no such file, or it couldn't be linked.
+    def link(self, identifier, filename, content_id):
+        source_identifier = self.state.get_content_source(content_id)
+        if source_identifier is None:
+            return False
+        source_path = os.path.join(self.dirname, self.state.get_filename(source_identifier))
+        try:
+            self.fsops.link(source_path, os.path.join(self.dirname, filename))
+        except OSError:
+            return False
+        self.listing_added(os.path.join(self.dirname, filename))
+        self.state.add(identifier, filename)
+        self.state.set_content(identifier, content_id)
+        info = self.state.get_info(source_identifier)
+        if info is not None:
+            self.state.set_info(identifier, info)
+        partial_filename = self.state.get_partial(identifier)
+        if partial_filename is not None:
+            # Left behind by an earlier attempt to download the file
+            partial_path = os.path.join(self.dirname, partial_filename)
+            if self.fsops.exists(partial_path):
+                self.delete_file(partial_path)
+            self.state.remove_partial(identifier)
+        self.counters['linked'] += 1
+        return True
+
+
+    def track_partial(self, identifier, filename):
+        partial_filename = self.get_partial_filename(identifier, filename)
+        old_partial_filename = self.state.get_partial(identifier)
+        if old_partial_filename is not None and old_partial_filename != partial_filename:
+            # The file has moved since the download was interrupted. Bring the
+            # partial file along so that the download can still be resumed.
+            old_path = os.path.join(self.dirname, old_partial_filename)
+            if self.fsops.exists(old_path):
+                self.rename_file(old_path, os.path.join(self.dirname, partial_filename))
+        self.state.add_partial(identifier, partial_filename)
+
+
+    def creation_failed(self, identifier, path):
+        self.state.remove_identifier(identifier)
+        # The creator may have left anything behind, so check the file itself
+        if self.fsops.exists(path):
+            self.delete_file(path)
+        self.listing_removed(path)
+
+
+    # Reap finished creators. Failed files are removed from the state, and the
+    # first error is raised once all finished creators have been handled.
+    # Copies that waited for a finished creator are created then, which may
+    # start new creators. Without raise_errors, as when winding down, copies
+    # are only linked, and left for the next sync if that isn't possible.
+    def wait_pending(self, return_when=concurrent.futures.ALL_COMPLETED,
+                     raise_errors=True):
+        error = None
+        while self.pending:
+            # wait() never counts futures that were cancelled without being
+            # notified as done, so they are reaped without waiting
+            done = set(future for future in self.pending if future.cancelled())
+            if not done:
+                done, _ = concurrent.futures.wait(self.pending, return_when=return_when)
+            copies = []
+            for future in done:
+                identifier, path, content_id = self.pending.pop(future)
+                self.pending_identifiers.pop(identifier, None)
+                waiting = self.pending_contents.pop(content_id, [])
+                if future.cancelled():
+                    # The copies are dropped along with it, and created next sync
+                    self.state.remove_identifier(identifier)
+                    self.listing_removed(path)
+                    continue
+                copies.extend((copy, content_id) for copy in waiting)
+                if future.exception() is not None:
+                    self.creation_failed(identifier, path)
+                    error = error or future.exception()
+                else:
+                    self.creation_completed(identifier, content_id, future.result())
+            for (identifier, filename, creator), content_id in copies:
+                if raise_errors:
+                    self.create(identifier, filename, creator, content_id)
+                else:
+                    self.link(identifier, filename, content_id)
+            if return_when != concurrent.futures.ALL_COMPLETED:
+                break
+        if error is not None and raise_errors:
+            raise error
 
 
     def move(self, identifier, new_filename, temporary=False):
@@ -164,39 +964,237 @@ class Filesystem:
                 return
             else:
                 self.move_temporary(other_identifier)
+        self.move_file(identifier, new_filename, temporary=temporary)
+
+
+    def move_temporary(self, identifier):
+        self.move(identifier, get_temporary_filename(), temporary=True)
+
+
+    # Wait for the creator of a file, if it is still pending, so that the file
+    # exists before it is moved. The file is gone if the creator was cancelled.
+    def wait_created(self, identifier):
+        future = self.pending_identifiers.get(identifier)
+        if future is not None and not future.done():
+            concurrent.futures.wait([future])
+        while identifier in self.pending_identifiers:
+            self.wait_pending(return_when=concurrent.futures.FIRST_COMPLETED)
+
+
+    # Rename a file, which must not collide with any other file
+    def move_file(self, identifier, new_filename, temporary=False):
+        self.wait_created(identifier)
+        if not self.state.has_identifier(identifier):
+            return
         old_filename = self.state.get_filename(identifier)
         old_path = os.path.join(self.dirname, old_filename)
         new_path = os.path.join(self.dirname, new_filename)
-        self.state.remove_identifier(identifier)
-        self.state.add(identifier, new_filename, temporary=temporary)
+        self.state.move(identifier, new_filename, temporary=temporary)
+        self.rename_file(old_path, new_path)
+
+
+    # Add a batch of files, typically all files in an album. Files that have
+    # been renamed are moved with as few renames as possible, so that
+    # reordering a large album costs one rename for each file that changed
+    # place, plus one extra for each cycle of files that swapped names.
+    def add_many(self, files):
+        moves = {}
+        creates = []
+        for spec in files:
+            if not self.state.has_identifier(spec.identifier):
+                creates.append(spec)
+                continue
+            old_filename = self.state.get_filename(spec.identifier)
+            if not self.file_exists(os.path.join(self.dirname, old_filename)):
+                # File has been deleted since last run, download again
+                self.state.remove_identifier(spec.identifier)
+                creates.append(spec)
+                continue
+            if spec.content_id is not None:
+                self.state.set_content(spec.identifier, spec.content_id)
+            if old_filename == spec.filename:
+                self.state.touch(spec.identifier, spec.filename)
+            else:
+                moves[old_filename] = spec.filename
+
+        # Files in the way that aren't moving elsewhere get a temporary name
+        for spec in files:
+            if spec.filename not in moves and self.state.has_filename(spec.filename):
+                other_identifier = self.state.get_identifier(spec.filename)
+                if other_identifier != spec.identifier:
+                    self.move_file(other_identifier, get_temporary_filename(), temporary=True)
+
+        targets = set(spec.filename for spec in files)
+        for old_filename, new_filename in plan_renames(moves, get_temporary_filename):
+            identifier = self.state.get_identifier(old_filename)
+            self.move_file(identifier, new_filename, temporary=new_filename not in targets)
+
+        for spec in creates:
+            self.add(spec.identifier, spec.filename, spec.creator, spec.content_id)
+
+
+    # Check every file against its recorded size and modification time. Only
+    # files that don't match, or that have no digest yet, are hashed, spread
+    # over the executor if one is given. Files that are missing or whose
+    # content has changed are removed, so that the next sync downloads them
+    # again. Returns their identifiers.
+    def verify(self, executor=None):
+        corrupt = []
+        to_hash = []
+        for identifier, filename in self.state.get_files():
+            path = os.path.join(self.dirname, filename)
+            try:
+                stat = self.stat_file(path)
+            except OSError:
+                corrupt.append(identifier)
+                continue
+            info = self.state.get_info(identifier)
+            if info is not None and stat.st_size != info.size:
+                corrupt.append(identifier)
+            elif info is None or info.mtime != stat.st_mtime:
+                to_hash.append((identifier, path, stat))
+
+        paths = [path for _, path, _ in to_hash]
+        if executor is not None:
+            digests = executor.map(self.fsops.hash, paths, chunksize=16)
+        else:
+            digests = map(self.fsops.hash, paths)
+        for (identifier, path, stat), digest in zip(to_hash, digests):
+            info = self.state.get_info(identifier)
+            if info is None or info.digest is None or info.digest == digest:
+                self.state.set_info(identifier, FileInfo(stat.st_size, digest, stat.st_mtime))
+            else:
+                corrupt.append(identifier)
+
+        for identifier in corrupt:
+            path = os.path.join(self.dirname, self.state.get_filename(identifier))
+            self.state.remove_identifier(identifier)
+            if self.file_exists(path):
+                self.delete_file(path)
+        self.counters['hashed'] += len(to_hash)
+        self.counters['corrupt'] += len(corrupt)
+        return corrupt
+
+
+    def rename_file(self, old_path, new_path):
         self.fsops.rename(old_path, new_path)
+        self.listing_removed(old_path)
+        self.listing_added(new_path)
+        self.counters['moved'] += 1
 
 
-    def move_temporary(self, identifier):
-        temp_filename = str(uuid.uuid4())
-        self.move(identifier, temp_filename, temporary=True)
+    def delete_file(self, path):
+        self.fsops.delete(path)
+        self.listing_removed(path)
+        self.counters['deleted'] += 1
 
 
-    def finish_sync(self):
+    # Files that weren't added since the last sync are deleted. If scope is
+    # given, only files in those directories are, so that a sync of some of
+    # the directories leaves the others alone.
+    def finish_sync(self, scope=None):
+        self.wait_pending()
+        if scope is not None:
+            scope = set(scope)
         untouched_filenames = self.state.get_untouched_filenames()
         for filename in untouched_filenames:
+            if scope is not None and os.path.dirname(filename) not in scope:
+                continue
             path = os.path.join(self.dirname, filename)
             self.state.remove_filename(filename)
-            self.fsops.delete(path)
+            self.delete_file(path)
         self.state.clear_touched_filenames()
-        for filename in self.state.temporary_filenames:
+        for filename in list(self.state.temporary_filenames):
             path = os.path.join(self.dirname, filename)
-            if self.state.has_filename(filename):
-                self.state.remove_filename(filename)
-            self.fsops.delete(path)
+            self.state.remove_filename(filename)
+            self.delete_file(path)
         self.state.clear_temporary_filenames()
+        # Partial files left at this point belong to files that are gone
+        for identifier, partial_filename in self.state.get_partials().items():
+            if scope is not None and os.path.dirname(partial_filename) not in scope:
+                continue
+            path = os.path.join(self.dirname, partial_filename)
+            if self.fsops.exists(path):
+                self.delete_file(path)
+            self.state.remove_partial(identifier)
+        self.listings.clear()
+
+
+    # Copy the files for which claims(identifier) is true from another state,
+    # typically the one that a new partition is split off from.
+    def import_files(self, state, claims):
+        for identifier, filename in state.get_files():
+            if claims(identifier) and not self.state.has_filename(filename):
+                self.import_file(state, identifier, filename)
+        # Imported files are only kept if they are added again during the sync
+        self.state.clear_touched_filenames()
+
+
+    def import_file(self, state, identifier, filename):
+        self.state.add(identifier, filename)
+        content_id = state.get_content(identifier)
+        if content_id is not None:
+            self.state.set_content(identifier, content_id)
+        info = state.get_info(identifier)
+        if info is not None:
+            self.state.set_info(identifier, info)
+
+
+    # Merge the states of partitions into this one, once each partition has
+    # synced its own directories, which together make up scope. Files in
+    # scope come from the partitions, and other files are kept as they are
+    # unless complete is true, meaning that scope covers every directory
+    # there should be. Files that aren't kept are deleted, and so are the
+    # partitions' states.
+    def merge(self, partitions, scope, complete=False):
+        self.wait_pending()
+        scope = set(scope)
+        states = [partition.state for partition in partitions] + [self.state]
+        merged = {}
+        merged_filenames = set()
+        for state in states:
+            for identifier, filename in state.get_files():
+                if state is self.state:
+                    keep = not complete and os.path.dirname(filename) not in scope
+                else:
+                    keep = os.path.dirname(filename) in scope
+                # The same photo may have been moved from another directory,
+                # or two partitions may have synced directories with the same name
+                if keep and identifier not in merged and filename not in merged_filenames:
+                    merged[identifier] = (state, filename)
+                    merged_filenames.add(filename)
+
+        for state in states:
+            for identifier, filename in state.get_files():
+                path = os.path.join(self.dirname, filename)
+                if filename not in merged_filenames and self.file_exists(path):
+                    self.delete_file(path)
+            for identifier, partial_filename in state.get_partials().items():
+                if complete or os.path.dirname(partial_filename) in scope:
+                    path = os.path.join(self.dirname, partial_filename)
+                    if self.fsops.exists(path):
+                        self.delete_file(path)
+                    state.remove_partial(identifier)
+                elif state is not self.state:
+                    self.state.add_partial(identifier, partial_filename)
+
+        for identifier, _ in self.state.get_files():
+            if merged.get(identifier, (None, None))[0] is not self.state:
+                self.state.remove_identifier(identifier)
+        for identifier, (state, filename) in merged.items():
+            if state is not self.state:
+                self.import_file(state, identifier, filename)
+        for partition in partitions:
+            partition.state.delete()
+        self.listings.clear()
 
 
     def save(self):
+        self.wait_pending(raise_errors=False)
         self.state.clear_touched_filenames()
-        for filename in self.state.temporary_filenames:
+        for filename in list(self.state.temporary_filenames):
             path = os.path.join(self.dirname, filename)
             self.state.remove_filename(filename)
-            self.fsops.delete(path)
+            self.delete_file(path)
         self.state.clear_temporary_filenames()
         self.state.save()
\ No newline at end of file
@@ -1,6 +1,9 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import concurrent.futures
+import tempfile
+import threading
 import unittest
 import sys
 import os.path
@@ -10,6 +13,27 @@ sys.path.insert(0, _dirname)
 import filesystem
 
 
+# Contains every file, except those removed from it
+class MockDirectoryListing(dict):
+    def __init__(self, exists_result):
+        super().__init__()
+        self.exists_result = exists_result
+        self.removed = set()
+        self.checked = []
+
+    def __contains__(self, name):
+        self.checked.append(name)
+        return dict.__contains__(self, name) or (self.exists_result and name not in self.removed)
+
+    def __setitem__(self, name, value):
+        self.removed.discard(name)
+        dict.__setitem__(self, name, value)
+
+    def pop(self, name, default=None):
+        self.removed.add(name)
+        return dict.pop(self, name, default)
+
+
 class MockFilesystemOperations:
     def __init__(self, exists_result=True):
         self.exists_result = exists_result
@@ -17,6 +41,8 @@ class MockFilesystemOperations:
         self.exists_called = False
         self.rename_called = False
         self.delete_called = False
+        self.linked = []
+        self.listings = {}
 
     def mkdir(self, _):
         self.mkdir_called = True
@@ -25,12 +51,19 @@ class MockFilesystemOperations:
         self.exists_called = True
         return self.exists_result
 
+    def list_directory(self, path):
+        self.listings[path] = MockDirectoryListing(self.exists_result)
+        return self.listings[path]
+
     def rename(self, _, __):
         self.rename_called = True
 
     def delete(self, _):
         self.delete_called = True
 
+    def link(self, src, dst):
+        self.linked.append((src, dst))
+
 
 class MockCreator:
     def __init__(self):
@@ -40,6 +73,17 @@ class MockCreator:
         self.creator_called = True
 
 
+# Queues everything it is given and never runs it
+class QueueingExecutor(concurrent.futures.Executor):
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.futures.append(future)
+        return future
+
+
 class TestFileSystem(unittest.TestCase):
 
     def test_add_file(self):
@@ -245,6 +289,694 @@ class TestFileSystem(unittest.TestCase):
         self.assertEqual('name3', fs.state.get_filename('d'))
         self.assertEqual('name2', fs.state.get_filename('e'))
         self.assertEqual('name6', fs.state.get_filename('f'))
+        self.assertEqual(6, fs.counters['created'])
+        self.assertEqual(1, fs.counters['deleted'])
+
+
+    def test_concurrent_creators(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creators = [MockCreator() for _ in range(10)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops,
+                                       executor=executor, max_pending=3)
+            for idx, mock_creator in enumerate(mock_creators):
+                fs.add(str(idx), 'name{}'.format(idx), mock_creator.creator)
+            fs.finish_sync()
+
+        self.assertTrue(all(c.creator_called for c in mock_creators))
+        self.assertEqual({}, fs.pending)
+        for idx in range(10):
+            self.assertEqual('name{}'.format(idx), fs.state.get_filename(str(idx)))
+
+
+    def test_concurrent_creator_fails(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator = MockCreator()
+        def failing_creator(_):
+            raise IOError('download failed')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops, executor=executor)
+            fs.add('a', 'name1', mock_creator.creator)
+            fs.add('b', 'name2', failing_creator)
+            with self.assertRaises(IOError):
+                fs.finish_sync()
+
+        self.assertTrue(fs.state.has_identifier('a'))
+        self.assertFalse(fs.state.has_identifier('b'))
+        self.assertTrue(mock_fsops.delete_called)
+
+
+    def test_failed_creator_keeps_partial(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator = MockCreator()
+        def failing_creator(_):
+            raise IOError('download failed')
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+
+        with self.assertRaises(IOError):
+            fs.add('a', 'album/name1', failing_creator)
+        self.assertFalse(fs.state.has_identifier('a'))
+        self.assertEqual(os.path.join('album', '.a.part'), fs.state.get_partial('a'))
+        self.assertEqual(os.path.join('dummy dir', 'album', '.a.part'),
+                         fs.get_partial_path('a', 'album/name1'))
+
+        # Retry with a new name, the partial file follows along
+        fs.add('a', 'other/name2', mock_creator.creator)
+        self.assertTrue(mock_creator.creator_called)
+        self.assertTrue(mock_fsops.rename_called)
+        self.assertIsNone(fs.state.get_partial('a'))
+
+
+    def test_finish_sync_removes_orphaned_partials(self):
+        mock_fsops = MockFilesystemOperations()
+        def failing_creator(_):
+            raise IOError('download failed')
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+
+        with self.assertRaises(IOError):
+            fs.add('a', 'name1', failing_creator)
+        mock_fsops.delete_called = False
+        fs.finish_sync()
+
+        self.assertIsNone(fs.state.get_partial('a'))
+        self.assertTrue(mock_fsops.delete_called)
+
+
+    def test_link_same_content(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator1 = MockCreator()
+        mock_creator2 = MockCreator()
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+
+        fs.add('album1-a', 'album1/name1', mock_creator1.creator, content_id='a')
+        fs.add('album2-a', 'album2/name1', mock_creator2.creator, content_id='a')
+
+        self.assertTrue(mock_creator1.creator_called)
+        self.assertFalse(mock_creator2.creator_called)
+        self.assertEqual([(os.path.join('dummy dir', 'album1/name1'),
+                           os.path.join('dummy dir', 'album2/name1'))], mock_fsops.linked)
+        self.assertEqual('album2/name1', fs.state.get_filename('album2-a'))
+        self.assertEqual(1, fs.counters['linked'])
+
+
+    def test_link_fails(self):
+        mock_fsops = MockFilesystemOperations()
+        def failing_link(_, __):
+            raise OSError('Operation not permitted')
+        mock_fsops.link = failing_link
+        mock_creator1 = MockCreator()
+        mock_creator2 = MockCreator()
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+
+        fs.add('album1-a', 'album1/name1', mock_creator1.creator, content_id='a')
+        fs.add('album2-a', 'album2/name1', mock_creator2.creator, content_id='a')
+
+        self.assertTrue(mock_creator1.creator_called)
+        self.assertTrue(mock_creator2.creator_called)
+
+
+    def test_link_same_content_while_pending(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator2 = MockCreator()
+        mock_creator3 = MockCreator()
+        started = threading.Event()
+        release = threading.Event()
+        def slow_creator(_):
+            started.set()
+            release.wait()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops, executor=executor)
+            fs.add('album1-a', 'album1/name1', slow_creator, content_id='a')
+            started.wait()
+            fs.add('album2-a', 'album2/name1', mock_creator2.creator, content_id='a')
+            fs.add('album3-a', 'album3/name1', mock_creator3.creator, content_id='a')
+            release.set()
+            fs.finish_sync()
+
+        self.assertFalse(mock_creator2.creator_called)
+        self.assertFalse(mock_creator3.creator_called)
+        self.assertEqual([os.path.join('dummy dir', 'album2/name1'),
+                          os.path.join('dummy dir', 'album3/name1')],
+                         [dst for _, dst in mock_fsops.linked])
+        self.assertEqual('album3/name1', fs.state.get_filename('album3-a'))
+        self.assertEqual(1, fs.counters['created'])
+        self.assertEqual(2, fs.counters['linked'])
+        self.assertEqual({}, fs.pending_contents)
+
+
+    def test_pending_content_creator_fails(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator2 = MockCreator()
+        mock_creator3 = MockCreator()
+        started = threading.Event()
+        release = threading.Event()
+        def failing_creator(_):
+            started.set()
+            release.wait()
+            raise IOError('download failed')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops, executor=executor)
+            fs.add('album1-a', 'album1/name1', failing_creator, content_id='a')
+            started.wait()
+            fs.add('album2-a', 'album2/name1', mock_creator2.creator, content_id='a')
+            fs.add('album3-a', 'album3/name1', mock_creator3.creator, content_id='a')
+            release.set()
+            with self.assertRaises(IOError):
+                fs.finish_sync()
+
+        # The first copy is created in its place, and the other one linked to it
+        self.assertFalse(fs.state.has_identifier('album1-a'))
+        self.assertTrue(mock_creator2.creator_called)
+        self.assertFalse(mock_creator3.creator_called)
+        self.assertEqual([(os.path.join('dummy dir', 'album2/name1'),
+                           os.path.join('dummy dir', 'album3/name1'))], mock_fsops.linked)
+        self.assertEqual('album3/name1', fs.state.get_filename('album3-a'))
+
+
+    def test_save_after_cancelling_queued_creators(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator = MockCreator()
+        executor = QueueingExecutor()
+        with tempfile.TemporaryDirectory() as dirname:
+            fs = filesystem.Filesystem(dirname, fsops=mock_fsops, executor=executor)
+            fs.add('album1-a', 'album1/name1', mock_creator.creator)
+            fs.add('album1-b', 'album1/name2', mock_creator.creator)
+            # As on Ctrl-C, the futures are cancelled without being notified
+            for future in executor.futures:
+                future.cancel()
+            fs.save()
+
+        self.assertFalse(fs.state.has_identifier('album1-a'))
+        self.assertFalse(fs.state.has_identifier('album1-b'))
+        self.assertEqual({}, fs.pending)
+
+
+    def test_move_file_while_pending(self):
+        # Two albums with the same title share a directory
+        with tempfile.TemporaryDirectory() as dirname:
+            release = threading.Event()
+            def slow_creator(path):
+                release.wait()
+                with open(path, 'w') as f:
+                    f.write('album1')
+            def creator(path):
+                with open(path, 'w') as f:
+                    f.write('album2')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                fs = filesystem.Filesystem(dirname, executor=executor)
+                os.mkdir(os.path.join(dirname, 'album'))
+                fs.add('album1-a', 'album/name1', slow_creator)
+                threading.Timer(0.1, release.set).start()
+                fs.add_many([filesystem.FileSpec('album2-a', 'album/name1', creator)])
+                fs.finish_sync()
+
+            self.assertEqual('album/name1', fs.state.get_filename('album2-a'))
+            with open(os.path.join(dirname, 'album/name1')) as f:
+                self.assertEqual('album2', f.read())
+            self.assertEqual(['name1'], os.listdir(os.path.join(dirname, 'album')))
+
+
+    def test_content_follows_moves(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator = MockCreator()
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+
+        fs.add('album1-a', 'album1/name1', mock_creator.creator, content_id='a')
+        fs.finish_sync()
+        fs.add('album1-a', 'album1/name2', mock_creator.creator, content_id='a')
+        fs.add('album2-a', 'album2/name1', mock_creator.creator, content_id='a')
+
+        self.assertEqual([(os.path.join('dummy dir', 'album1/name2'),
+                           os.path.join('dummy dir', 'album2/name1'))], mock_fsops.linked)
+
+
+    def test_renamed_file_exists_check(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator1 = MockCreator()
+        mock_creator2 = MockCreator()
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+
+        fs.add('a', 'name1', mock_creator1.creator)
+        fs.finish_sync()
+        fs.add('a', 'name2', mock_creator2.creator)
+
+        self.assertFalse(mock_creator2.creator_called)
+        self.assertEqual('name1', mock_fsops.listings['dummy dir'].checked[-1])
+
+
+    def test_file_info(self):
+        mock_fsops = MockFilesystemOperations()
+        info = filesystem.FileInfo(1234, 'abcd')
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+
+        fs.add('album1-a', 'album1/name1', lambda _: info, content_id='a')
+        fs.add('album2-a', 'album2/name1', MockCreator().creator, content_id='a')
+        fs.finish_sync()
+        fs.add('album1-a', 'album1/name2', MockCreator().creator, content_id='a')
+
+        self.assertEqual(info, fs.state.get_info('album1-a'))
+        self.assertEqual(info, fs.state.get_info('album2-a'))
+
+
+    def test_finish_sync_scope(self):
+        mock_fsops = MockFilesystemOperations()
+        fs = filesystem.Filesystem('dummy dir', fsops=mock_fsops)
+        fs.add('album1-a', 'album1/name1', MockCreator().creator)
+        fs.add('album1-b', 'album1/name2', MockCreator().creator)
+        fs.add('album2-c', 'album2/name1', MockCreator().creator)
+        fs.finish_sync()
+
+        fs.state.add_partial('album2-d', 'album2/.album2-d.part')
+        fs.add('album1-a', 'album1/name1', MockCreator().creator)
+        fs.finish_sync(scope=['album1'])
+
+        self.assertFalse(fs.state.has_identifier('album1-b'))
+        self.assertTrue(fs.state.has_identifier('album2-c'))
+        self.assertEqual({'album2-d': 'album2/.album2-d.part'}, fs.state.get_partials())
+        self.assertEqual(1, fs.counters['deleted'])
+
+
+class TestAddMany(unittest.TestCase):
+
+    def get_filesystem(self, names):
+        self.mock_fsops = MockFilesystemOperations()
+        self.renames = []
+        self.mock_fsops.rename = lambda old, new: self.renames.append((old, new))
+        fs = filesystem.Filesystem('dummy dir', fsops=self.mock_fsops)
+        fs.add_many([filesystem.FileSpec(identifier, name, MockCreator().creator)
+                     for identifier, name in names])
+        fs.finish_sync()
+        self.renames.clear()
+        return fs
+
+
+    def assert_filenames(self, fs, names):
+        for identifier, name in names:
+            self.assertEqual(name, fs.state.get_filename(identifier))
+        self.assertEqual(set(), fs.state.temporary_filenames)
+
+
+    def test_insert_at_front(self):
+        old_names = [(str(idx), '{:03d}'.format(idx)) for idx in range(1, 100)]
+        new_names = [(str(idx), '{:03d}'.format(idx + 1)) for idx in range(1, 100)]
+        fs = self.get_filesystem(old_names)
+        mock_creator = MockCreator()
+
+        fs.add_many([filesystem.FileSpec('new', '001', mock_creator.creator)] +
+                    [filesystem.FileSpec(identifier, name, MockCreator().creator)
+                     for identifier, name in new_names])
+        fs.finish_sync()
+
+        self.assertTrue(mock_creator.creator_called)
+        self.assertEqual(99, len(self.renames))
+        self.assertFalse(self.mock_fsops.delete_called)
+        self.assert_filenames(fs, new_names + [('new', '001')])
+
+
+    def test_swap(self):
+        fs = self.get_filesystem([('a', 'name1'), ('b', 'name2'), ('c', 'name3')])
+
+        fs.add_many([filesystem.FileSpec('a', 'name1', MockCreator().creator),
+                     filesystem.FileSpec('b', 'name3', MockCreator().creator),
+                     filesystem.FileSpec('c', 'name2', MockCreator().creator)])
+        fs.finish_sync()
+
+        # One cycle, broken with one temporary name
+        self.assertEqual(3, len(self.renames))
+        self.assertFalse(self.mock_fsops.delete_called)
+        self.assert_filenames(fs, [('a', 'name1'), ('b', 'name3'), ('c', 'name2')])
+
+
+    def test_removed_file_in_the_way(self):
+        fs = self.get_filesystem([('a', 'name1'), ('b', 'name2')])
+        mock_creator = MockCreator()
+
+        # a is removed, b takes its name and c is added
+        fs.add_many([filesystem.FileSpec('b', 'name1', MockCreator().creator),
+                     filesystem.FileSpec('c', 'name2', mock_creator.creator)])
+        fs.finish_sync()
+
+        self.assertTrue(mock_creator.creator_called)
+        self.assertTrue(self.mock_fsops.delete_called)
+        self.assertFalse(fs.state.has_identifier('a'))
+        self.assert_filenames(fs, [('b', 'name1'), ('c', 'name2')])
+
+
+    def test_plan_renames(self):
+        temporary_filenames = iter(['tmp1', 'tmp2'])
+        plan = filesystem.plan_renames({'a': 'b', 'b': 'c', 'c': 'a', 'd': 'e', 'e': 'f'},
+                                       lambda: next(temporary_filenames))
+
+        self.assertEqual(6, len(plan))
+        files = {name: name for name in 'abcde'}
+        for old_filename, new_filename in plan:
+            self.assertNotIn(new_filename, files)
+            files[new_filename] = files.pop(old_filename)
+        self.assertEqual({'b': 'a', 'c': 'b', 'a': 'c', 'e': 'd', 'f': 'e'}, files)
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+        self.fs = filesystem.Filesystem(self.dirname)
+        for name in ['name1', 'name2', 'name3', 'name4']:
+            self.fs.add(name, name, self.write_file)
+        self.fs.finish_sync()
+
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+    def write_file(self, path):
+        with open(path, 'w') as f:
+            f.write(os.path.basename(path))
+        return filesystem.FileInfo(5, filesystem.hash_file(path), os.stat(path).st_mtime)
+
+
+    def test_verify(self):
+        hashed_paths = []
+        def mock_hash(path):
+            hashed_paths.append(path)
+            return filesystem.hash_file(path)
+        self.fs.fsops.hash = mock_hash
+        # name2 is missing, name3 is truncated and name4 has changed content
+        os.unlink(os.path.join(self.dirname, 'name2'))
+        with open(os.path.join(self.dirname, 'name3'), 'w') as f:
+            f.write('name')
+        with open(os.path.join(self.dirname, 'name4'), 'w') as f:
+            f.write('nameX')
+        os.utime(os.path.join(self.dirname, 'name4'), (0, 12345))
+
+        corrupt = self.fs.verify()
+
+        self.assertEqual({'name2', 'name3', 'name4'}, set(corrupt))
+        self.assertEqual([os.path.join(self.dirname, 'name4')], hashed_paths)
+        self.assertTrue(self.fs.state.has_identifier('name1'))
+        self.assertFalse(self.fs.state.has_identifier('name4'))
+        self.assertEqual(['name1'], sorted(name for name in os.listdir(self.dirname)
+                                           if name.startswith('name')))
+
+
+    def test_verify_touched_file(self):
+        os.utime(os.path.join(self.dirname, 'name1'), (0, 12345))
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            corrupt = self.fs.verify(executor)
+
+        self.assertEqual([], corrupt)
+        self.assertEqual(12345, self.fs.state.get_info('name1').mtime)
+
+
+class TestDirectoryListing(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+        self.created = []
+
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+    def write_file(self, path):
+        self.created.append(os.path.relpath(path, self.dirname))
+        with open(path, 'w') as f:
+            f.write('content')
+
+
+    def sync(self, albums):
+        fsops = filesystem.FilesystemOperations()
+        listed = []
+        self.checked = []
+        def exists(path):
+            self.checked.append(path)
+            return os.path.exists(path)
+        fsops.exists = exists
+        def list_directory(path):
+            listed.append(os.path.relpath(path, self.dirname))
+            return filesystem.list_directory(path)
+        fsops.list_directory = list_directory
+        fs = filesystem.Filesystem(self.dirname, fsops=fsops)
+        for album, names in albums.items():
+            os.makedirs(os.path.join(self.dirname, album), exist_ok=True)
+            fs.add_many([filesystem.FileSpec(album + name, os.path.join(album, name), self.write_file)
+                         for name in names])
+        fs.finish_sync()
+        fs.save()
+        return listed
+
+
+    def test_one_listing_per_directory(self):
+        albums = {'album1': ['a', 'b', 'c'], 'album2': ['d', 'e']}
+        self.sync(albums)
+        self.created.clear()
+        os.unlink(os.path.join(self.dirname, 'album1', 'b'))
+
+        listed = self.sync(albums)
+
+        self.assertEqual(['album1', 'album2'], sorted(listed))
+        # Only the directory itself is checked, not the files in it
+        self.assertEqual([self.dirname], self.checked)
+        self.assertEqual([os.path.join('album1', 'b')], self.created)
+
+
+    def test_renamed_files_are_listed(self):
+        self.sync({'album1': ['a', 'b']})
+        self.created.clear()
+
+        self.sync({'album1': ['b', 'c']})
+        self.sync({'album1': ['b', 'c']})
+
+        self.assertEqual([os.path.join('album1', 'c')], self.created)
+        self.assertEqual(['b', 'c'], sorted(os.listdir(os.path.join(self.dirname, 'album1'))))
+
+
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+        for album in ['album1', 'album2', 'album3']:
+            os.mkdir(os.path.join(self.dirname, album))
+
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+    def write_file(self, path):
+        with open(path, 'w') as f:
+            f.write(os.path.basename(path))
+
+
+    def sync(self, fs, files, scope=None):
+        fs.add_many([filesystem.FileSpec(identifier, filename, self.write_file)
+                     for identifier, filename in files])
+        fs.finish_sync(scope)
+        fs.save()
+
+
+    def list_files(self):
+        return sorted(os.path.join(album, name) for album in os.listdir(self.dirname)
+                      if os.path.isdir(os.path.join(self.dirname, album))
+                      for name in os.listdir(os.path.join(self.dirname, album)))
+
+
+    def split(self, backend):
+        fs = filesystem.Filesystem(self.dirname, backend=backend)
+        self.sync(fs, [('1a', 'album1/a'), ('1b', 'album1/b'),
+                       ('2c', 'album2/c'), ('3d', 'album3/d')])
+        fs.state.close()
+        partitions = []
+        for partition, album in [('p1', '1'), ('p2', '2')]:
+            partitions.append(filesystem.Filesystem(self.dirname, backend=backend,
+                                                    partition=partition))
+            merged = filesystem.Filesystem(self.dirname, backend=backend)
+            partitions[-1].import_files(merged.state,
+                                        lambda identifier: identifier.startswith(album))
+            merged.state.close()
+        return partitions
+
+
+    def test_import_files(self):
+        p1, p2 = self.split('journal')
+
+        self.assertEqual([('1a', 'album1/a'), ('1b', 'album1/b')], sorted(p1.state.get_files()))
+        self.assertEqual([('2c', 'album2/c')], p2.state.get_files())
+        self.assertEqual(set(), p1.state.touched_filenames)
+
+
+    def test_merge(self):
+        for backend in ['pickle', 'journal', 'sqlite']:
+            with self.subTest(backend=backend):
+                p1, p2 = self.split(backend)
+                self.sync(p1, [('1b', 'album1/a'), ('1e', 'album1/e')], scope=['album1'])
+                self.sync(p2, [], scope=['album2'])
+
+                fs = filesystem.Filesystem(self.dirname, backend=backend)
+                fs.merge([p1, p2], ['album1', 'album2'])
+                fs.save()
+
+                self.assertEqual(['album1/a', 'album1/e', 'album3/d'], self.list_files())
+                fs = filesystem.Filesystem(self.dirname, backend=backend)
+                self.assertEqual([('1b', 'album1/a'), ('1e', 'album1/e'), ('3d', 'album3/d')],
+                                 sorted(fs.state.get_files()))
+                self.assertFalse(filesystem.Filesystem(self.dirname, backend=backend,
+                                                       partition='p1').state.get_files())
+                fs.state.close()
+                self.tearDown()
+                self.setUp()
+
+
+    def test_merge_complete(self):
+        p1, p2 = self.split('pickle')
+        self.sync(p1, [('1a', 'album1/a'), ('1b', 'album1/b')], scope=['album1'])
+        self.sync(p2, [('2c', 'album2/c')], scope=['album2'])
+
+        fs = filesystem.Filesystem(self.dirname)
+        fs.merge([p1, p2], ['album1', 'album2'], complete=True)
+
+        self.assertEqual(['album1/a', 'album1/b', 'album2/c'], self.list_files())
+        self.assertFalse(fs.state.has_identifier('3d'))
+
+
+class TestJournaledFilesystemState(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+    def test_recover_without_save(self):
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        state.add('a', 'name1')
+        state.add('b', 'name2')
+        state.remove_filename('name1')
+        state.add_partial('c', '.c.part')
+        state.set_content('b', 'content-b')
+        state.set_info('b', filesystem.FileInfo(10, 'abcd'))
+        state.move('b', 'name3')
+        state.journal.close()
+
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        self.assertFalse(state.has_identifier('a'))
+        self.assertEqual('name3', state.get_filename('b'))
+        self.assertEqual(filesystem.FileInfo(10, 'abcd'), state.get_info('b'))
+        self.assertEqual('.c.part', state.get_partial('c'))
+        self.assertEqual('b', state.get_content_source('content-b'))
+        self.assertEqual(set(), state.touched_filenames)
+
+
+    def test_compaction(self):
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        state.add('a', 'name1')
+        state.compact()
+        state.add('b', 'name2')
+        state.journal.close()
+
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        self.assertEqual('name1', state.get_filename('a'))
+        self.assertEqual('name2', state.get_filename('b'))
+
+
+    def test_ignore_folded_journal(self):
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        state.add('a', 'name1')
+        journal = open(state.journal_path).read()
+        state.save()
+        state.journal.close()
+        # Simulate a crash after writing the snapshot, but before the journal
+        # was started over
+        with open(state.journal_path, 'w') as f:
+            f.write(journal)
+
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        self.assertEqual('name1', state.get_filename('a'))
+
+
+    def test_truncated_record(self):
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        state.add('a', 'name1')
+        state.journal.write('["add", "b", "na')
+        state.journal.close()
+
+        state = filesystem.JournaledFilesystemState(self.dirname)
+        self.assertEqual('name1', state.get_filename('a'))
+        self.assertFalse(state.has_identifier('b'))
+
+
+class TestSqliteFilesystemState(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+    def test_complex_case(self):
+        mock_fsops = MockFilesystemOperations()
+        mock_creator = MockCreator()
+        mock_creator_a = MockCreator()
+        mock_creator_e = MockCreator()
+        fs = filesystem.Filesystem(self.dirname, fsops=mock_fsops, backend='sqlite')
+
+        # First sync
+        fs.add('a', 'name1', mock_creator.creator)
+        fs.add('b', 'name2', mock_creator.creator)
+        fs.add('c', 'name3', mock_creator.creator)
+        fs.add('d', 'name4', mock_creator.creator)
+        fs.finish_sync()
+        fs.save()
+        # Second sync in a new process:
+        # - b is removed
+        # - c and d switches name
+        # - e is added with name of b
+        fs = filesystem.Filesystem(self.dirname, fsops=mock_fsops, backend='sqlite')
+        fs.add('a', 'name1', mock_creator_a.creator)
+        fs.add('c', 'name4', mock_creator.creator)
+        fs.add('d', 'name3', mock_creator.creator)
+        fs.add('e', 'name2', mock_creator_e.creator)
+        # Only b, which was moved to a temporary name, is left untouched
+        untouched_filenames = fs.state.get_untouched_filenames()
+        self.assertEqual(1, len(untouched_filenames))
+        self.assertEqual('b', fs.state.get_identifier(untouched_filenames.pop()))
+        fs.finish_sync()
+
+        self.assertFalse(mock_creator_a.creator_called)
+        self.assertTrue(mock_creator_e.creator_called)
+        self.assertFalse(fs.state.has_identifier('b'))
+        self.assertEqual('name1', fs.state.get_filename('a'))
+        self.assertEqual('name4', fs.state.get_filename('c'))
+        self.assertEqual('name3', fs.state.get_filename('d'))
+        self.assertEqual('e', fs.state.get_identifier('name2'))
+
+
+    def test_import_pickled_state(self):
+        state = filesystem.FilesystemState(self.dirname)
+        state.add('a', 'name1')
+        state.set_content('a', 'content-a')
+        state.set_info('a', filesystem.FileInfo(10, 'abcd'))
+        state.add_partial('b', '.b.part')
+        state.save()
+
+        state = filesystem.SqliteFilesystemState(self.dirname)
+        self.assertEqual('name1', state.get_filename('a'))
+        self.assertEqual('a', state.get_content_source('content-a'))
+        self.assertEqual(filesystem.FileInfo(10, 'abcd'), state.get_info('a'))
+        self.assertEqual({'b': '.b.part'}, state.get_partials())
+        self.assertEqual({'name1'}, state.get_untouched_filenames())
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,11 +1,34 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import array
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import datetime
+import email.utils
+import fnmatch
+import hashlib
+import itertools
+import json
 import math
+import multiprocessing
 import os
 import pickle
+import pstats
+import queue
+import random
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
 import urllib
+import zlib
 import requests
+import requests.adapters
 import configparser
 import argparse
 import logging
@@ -23,8 +46,304 @@ def first_line(string):
     return string.split(os.linesep)[0]
 
 
-# The flickr API can be a bit flaky at times. We use this decorator to retry
-# API calls that fail a few times. Usually it's enough to try once more for each call.
+# Timers and counters for a run. Phases may run on several threads at once, so
+# phase times are the total time spent in each phase across all threads.
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiler = None
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.phases = collections.defaultdict(lambda: [0, 0.0])
+            self.api_calls = collections.defaultdict(lambda: [0, 0.0])
+            self.counters = collections.Counter()
+
+
+    # Time spent in a phase nested in the same phase on the same thread is only
+    # counted once. Phases are also traced and profiled when that is enabled,
+    # with args added to the trace span.
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        active = self.local.__dict__.setdefault('active', set())
+        if name in active:
+            yield
+            return
+        active.add(name)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter(name)
+        start = time.monotonic()
+        try:
+            with tracer.span(name, 'phase', **args):
+                yield
+        finally:
+            active.discard(name)
+            self.add(self.phases, name, time.monotonic() - start)
+            if profiler is not None:
+                profiler.exit()
+
+
+    def api_call(self, method_name, seconds):
+        self.add(self.api_calls, method_name, seconds)
+
+
+    def add(self, timers, name, seconds):
+        with self.lock:
+            timers[name][0] += 1
+            timers[name][1] += seconds
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+
+    def get_report(self):
+        with self.lock:
+            return {'started': self.started,
+                    'wall_seconds': time.time() - self.started,
+                    'phases': {name: {'count': count, 'seconds': seconds}
+                               for name, (count, seconds) in self.phases.items()},
+                    'api_calls': {name: {'count': count, 'seconds': seconds}
+                                  for name, (count, seconds) in self.api_calls.items()},
+                    'counters': dict(self.counters)}
+
+
+    def write_report(self, path, **extra):
+        report = self.get_report()
+        report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+    # Written in the Prometheus text format, for node_exporter's textfile collector
+    def write_prometheus_textfile(self, path, **extra):
+        report = self.get_report()
+        lines = ['flickr_downloader_last_run_timestamp_seconds {}'.format(report['started']),
+                 'flickr_downloader_run_seconds {}'.format(report['wall_seconds'])]
+        for name, timer in sorted(report['phases'].items()):
+            lines.append('flickr_downloader_phase_seconds_total{{phase="{}"}} {}'
+                         .format(name, timer['seconds']))
+            lines.append('flickr_downloader_phase_count_total{{phase="{}"}} {}'
+                         .format(name, timer['count']))
+        for name, timer in sorted(report['api_calls'].items()):
+            lines.append('flickr_downloader_api_call_seconds_total{{method="{}"}} {}'
+                         .format(name, timer['seconds']))
+            lines.append('flickr_downloader_api_calls_total{{method="{}"}} {}'
+                         .format(name, timer['count']))
+        for name, value in sorted(list(report['counters'].items()) + list(extra.items())):
+            lines.append('flickr_downloader_{} {}'.format(name, value))
+        # Write to a temporary file first so that the collector never sees a partial file
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+metrics = RunMetrics()
+
+
+# Records spans in the Chrome trace event format, to be opened in
+# chrome://tracing or https://ui.perfetto.dev. Events are written out as they
+# are recorded, so that tracing a long run doesn't hold them all in memory.
+# span() does nothing until start() is called.
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.thread_names = {}
+
+
+    def start(self, path):
+        self.file = open(path, 'w')
+        self.file.write('[')
+        self.separator = '\n'
+        self.started = time.perf_counter()
+        self.pid = os.getpid()
+
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        if self.file is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.perf_counter() - start, args)
+
+
+    def record(self, name, category, start, seconds, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid,
+                 'tid': thread.ident, 'ts': (start - self.started) * 1e6, 'dur': seconds * 1e6}
+        if args:
+            event['args'] = args
+        line = json.dumps(event, default=str)
+        with self.lock:
+            if self.file is None:
+                return
+            self.thread_names[thread.ident] = thread.name
+            self.file.write(self.separator + line)
+            self.separator = ',\n'
+
+
+    # Threads are named in the trace by metadata events
+    def stop(self):
+        with self.lock:
+            if self.file is None:
+                return
+            for ident, name in sorted(self.thread_names.items()):
+                self.file.write(self.separator + json.dumps(
+                    {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': ident,
+                     'args': {'name': name}}))
+                self.separator = ',\n'
+            self.file.write('\n]\n')
+            self.file.close()
+            self.file = None
+            self.thread_names.clear()
+
+
+tracer = Tracer()
+
+
+# Profiles each phase with cProfile, so that the time spent in a phase can be
+# broken down by function. A thread only profiles the innermost phase it is in.
+# Time spent on the thread that started the profiler outside of any phase is
+# profiled as the 'main' phase. From Python 3.12, cProfile can only profile one
+# thread at a time, so only phases on the thread that started the profiler
+# are profiled there. The trace shows the phases on the other threads.
+class PhaseProfiler:
+    ALL_THREADS = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = collections.defaultdict(list)
+        self.thread = None
+
+
+    def is_profiled(self):
+        return self.ALL_THREADS or threading.get_ident() == self.thread
+
+
+    def get_profile(self, name):
+        profiles = self.local.__dict__.setdefault('profiles', {})
+        if name not in profiles:
+            profiles[name] = cProfile.Profile()
+            with self.lock:
+                self.profiles[name].append(profiles[name])
+        return profiles[name]
+
+
+    def enter(self, name):
+        if not self.is_profiled():
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        if stack:
+            stack[-1].disable()
+        stack.append(self.get_profile(name))
+        stack[-1].enable()
+
+
+    def exit(self):
+        if not self.is_profiled():
+            return
+        stack = self.local.stack
+        stack.pop().disable()
+        if stack:
+            stack[-1].enable()
+
+
+    def start(self):
+        self.thread = threading.get_ident()
+        self.enter('main')
+
+
+    def stop(self):
+        self.exit()
+
+
+    # Writes the stats of each phase, merged across threads, to <phase>.prof
+    # in dirname. They can be read with pstats or snakeviz.
+    def write(self, dirname, shard=None):
+        os.makedirs(dirname, exist_ok=True)
+        with self.lock:
+            profiles = {name: list(phase_profiles) for name, phase_profiles in self.profiles.items()}
+        for name, phase_profiles in sorted(profiles.items()):
+            stats = pstats.Stats(*phase_profiles)
+            path = get_shard_path(dirname, '{}.prof'.format(name), shard)
+            stats.dump_stats(path)
+            print('Profile of phase {} ({:.1f}s in {} calls) written to {}'
+                  .format(name, stats.total_tt, stats.total_calls, path))
+
+
+@contextlib.contextmanager
+def traced(path):
+    if path is None:
+        yield
+        return
+    tracer.start(path)
+    try:
+        yield
+    finally:
+        tracer.stop()
+        print('Trace written to {}'.format(path))
+
+
+@contextlib.contextmanager
+def profiled(dirname, shard=None):
+    if dirname is None:
+        yield
+        return
+    profiler = metrics.profiler = PhaseProfiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        metrics.profiler = None
+        profiler.write(dirname, shard)
+
+
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+
+# Exponential backoff with full jitter, so that concurrent workers that failed
+# at the same time don't all retry at the same time as well
+def get_backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+# Seconds to wait as asked for by a Retry-After header on the failed response, if any
+def get_retry_after(exception):
+    response = getattr(exception, 'response', None)
+    value = getattr(response, 'headers', {}).get('Retry-After')
+    if value is None:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, retry_at.timestamp() - time.time())
+
+
+def get_retry_delay(exception, attempt):
+    return max(get_retry_after(exception), get_backoff_delay(attempt))
+
+
+# Flickr can be a bit flaky at times. We use this decorator to retry calls
+# that fail a few times, backing off a little more for each attempt.
 def retry(ExceptionsToCheck, tries=4):
     def real_decorator(func):
         def f_retry(*args, **kwargs):
@@ -34,9 +353,12 @@ def retry(ExceptionsToCheck, tries=4):
                     return func(*args, **kwargs)
                 except ExceptionsToCheck as e:
                     mtries -= 1
-                    msg = "{} failed with '{}', retrying... ({} attempts left)"             \
-                          .format(func.__name__, first_line(str(e)), mtries)
+                    metrics.count('retries')
+                    delay = get_retry_delay(e, tries - mtries - 1)
+                    msg = "{} failed with '{}', retrying in {:.1f}s... ({} attempts left)"  \
+                          .format(func.__name__, first_line(str(e)), delay, mtries)
                     print(msg)
+                    time.sleep(delay)
             return func(*args, **kwargs)
         return f_retry
     return real_decorator
@@ -45,35 +367,802 @@ def retry(ExceptionsToCheck, tries=4):
 # Network exceptions could be worth retrying
 NETWORK_EXCEPTIONS = (requests.exceptions.BaseHTTPError,
                       requests.exceptions.ConnectionError,
+                      requests.exceptions.HTTPError,
+                      requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError,
                       flickrapi.exceptions.FlickrError,
                       urllib.error.HTTPError)
 
 
+# Flickr API error codes for trouble on Flickr's side, which may go away
+# when retried. Other API errors, such as 1 for a photoset that is not found
+# or 100 for an invalid API key, are permanent.
+FLICKR_TRANSIENT_ERRORS = {0, 10, 105, 106}
+
+
+def is_permanent_error(exception):
+    code = getattr(exception, 'code', None)
+    return isinstance(exception, flickrapi.exceptions.FlickrError) and code is not None \
+        and code not in FLICKR_TRANSIENT_ERRORS
+
+
+# Thread safe token bucket. take() blocks until the tokens are available.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def take(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the tokens right away, going into debt if need be, so
+            # that waiting callers are served in order
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Stops all calls for a while once too many calls in a row have failed, to give
+# the other end time to recover instead of hammering it with retries.
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        with self.lock:
+            wait = self.open_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = time.monotonic() + self.cooldown
+                print("{} calls in a row failed, pausing for {}s"
+                      .format(self.failures, self.cooldown))
+
+
+# How many operations of a kind may run at once, adjusted with additive
+# increase and multiplicative decrease like TCP congestion control. The limit
+# grows by one for each limit's worth of operations that succeed, and is halved
+# when one fails or is slow to respond: SLOW_FACTOR times slower than the
+# average latency, plus SLOW_MARGIN so that jitter in fast responses isn't
+# taken for trouble. It is halved at most once per average latency, so that a
+# burst of failures of operations that ran at the same time only counts once.
+# Until the first decrease, the limit grows by one for each operation that
+# succeeds instead, to find its level quickly.
+class AdaptiveLimit:
+    SLOW_FACTOR = 3
+    SLOW_MARGIN = 0.1
+    LATENCY_WEIGHT = 0.1
+
+    def __init__(self, name, initial, maximum, minimum=1):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.latency = None
+        self.slow_start = True
+        self.decreased = 0
+        self.condition = threading.Condition()
+
+
+    def get_limit(self):
+        return int(self.limit)
+
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+
+    def __enter__(self):
+        self.acquire()
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+    # latency is how long the operation took to respond
+    def success(self, latency):
+        with self.condition:
+            slow = self.latency is not None and \
+                latency > self.SLOW_FACTOR * self.latency + self.SLOW_MARGIN
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+            if slow:
+                self.decrease('slow responses')
+            elif self.limit < self.maximum:
+                self.set_limit(self.limit + (1 if self.slow_start else 1 / self.limit))
+
+
+    def failure(self):
+        with self.condition:
+            self.decrease('errors')
+
+
+    def decrease(self, reason):
+        now = time.monotonic()
+        if now - self.decreased < (self.latency or 0):
+            return
+        self.decreased = now
+        self.slow_start = False
+        metrics.count('{}_limit_decreases'.format(self.name.lower()))
+        self.set_limit(self.limit / 2, reason)
+
+
+    # Only decreases are printed, the current limits are shown with the progress
+    def set_limit(self, limit, reason=None):
+        old_limit = int(self.limit)
+        self.limit = max(self.minimum, min(limit, self.maximum))
+        if int(self.limit) < old_limit:
+            print('{} concurrency lowered to {} after {}'.format(self.name, int(self.limit), reason))
+        elif int(self.limit) > old_limit:
+            self.condition.notify_all()
+
+
+    def __str__(self):
+        return '{} concurrency {}'.format(self.name, self.get_limit())
+
+
+# Flickr allows 3600 calls per hour for each API key
+FLICKR_CALLS_PER_HOUR = 3600
+FLICKR_BURST = 50
+
+
+# All Flickr API calls go through a shared scheduler that keeps us within the
+# quota, retries failed calls with backoff and pauses when Flickr is struggling.
+class ApiScheduler:
+    def __init__(self, calls_per_hour=FLICKR_CALLS_PER_HOUR, burst=FLICKR_BURST, tries=4,
+                 limit=None):
+        self.bucket = TokenBucket(calls_per_hour / 3600, burst)
+        self.breaker = CircuitBreaker()
+        self.tries = tries
+        self.limit = limit
+
+
+    def call(self, name, func, *args, **kwargs):
+        for attempt in range(self.tries):
+            self.breaker.wait()
+            self.bucket.take()
+            try:
+                with self.limit or contextlib.nullcontext():
+                    start = time.monotonic()
+                    with tracer.span(name, 'api', attempt=attempt):
+                        result = func(*args, **kwargs)
+            except NETWORK_EXCEPTIONS as e:
+                seconds = time.monotonic() - start
+                metrics.api_call(name, seconds)
+                if is_permanent_error(e):
+                    # Flickr answered, it just won't do what was asked
+                    self.breaker.success()
+                    if self.limit is not None:
+                        self.limit.success(seconds)
+                    raise
+                self.breaker.failure()
+                if self.limit is not None:
+                    self.limit.failure()
+                if attempt == self.tries - 1:
+                    raise
+                metrics.count('api_retries')
+                delay = get_retry_delay(e, attempt)
+                print("{} failed with '{}', retrying in {:.1f}s... ({} attempts left)"
+                      .format(name, first_line(str(e)), delay, self.tries - attempt - 1))
+                time.sleep(delay)
+            else:
+                seconds = time.monotonic() - start
+                metrics.api_call(name, seconds)
+                self.breaker.success()
+                if self.limit is not None:
+                    self.limit.success(seconds)
+                return result
+
+
+# flickrapi raises a FlickrError without the response when Flickr answers
+# with an HTTP error. The response is attached to the error as it is to those
+# of requests, so that the scheduler can honour its Retry-After header.
+class ScheduledFlickrAPI(flickrapi.FlickrAPI):
+    def __init__(self, *args, scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        self.responses = threading.local()
+        # Rather than the session that flickrapi shares between all clients
+        self.flickr_oauth.session = requests.Session()
+        self.flickr_oauth.session.hooks['response'].append(self.remember_response)
+
+
+    def remember_response(self, response, *args, **kwargs):
+        self.responses.last = response
+
+
+    def do_flickr_call(self, method_name, *args, **kwargs):
+        return self.scheduler.call(method_name, self.call_api, method_name, *args, **kwargs)
+
+
+    def call_api(self, method_name, *args, **kwargs):
+        self.responses.last = None
+        try:
+            return super().do_flickr_call(method_name, *args, **kwargs)
+        except flickrapi.exceptions.FlickrError as e:
+            response = self.responses.last
+            if e.code is None and response is not None and response.status_code != 200:
+                e.response = response
+            raise
+
+
 class AlbumDownloadSpec:
-    def __init__(self, name, identifier):
+    def __init__(self, name, identifier, photos=None, resolver=None):
         self.name = name
         self.identifier = identifier
-        self.photos = []
+        self.photos = photos if photos is not None else PhotoList()
+        self.resolver = resolver
 
 
+# The url is None if the photo listing didn't include it, see UrlResolver
 class PhotoDownloadSpec:
-    def __init__(self, flickr, name, identifier, filetype):
-        self._flickr = flickr
+    __slots__ = ['name', 'identifier', 'filetype', 'url', 'lastupdate', 'media', 'pixels',
+                 'dateupload']
+
+    def __init__(self, name, identifier, filetype, url=None, lastupdate=None,
+                 media=None, pixels=None, dateupload=None):
         self.name = name
         self.identifier = identifier
         self.filetype = filetype
+        self.url = url
+        self.lastupdate = lastupdate
+        self.media = media
+        self.pixels = pixels
+        self.dateupload = dateupload
+
+
+ORIGINAL_URL = re.compile(r'https://live\.staticflickr\.com/(\d+)/(\d+)_([0-9a-f]{10})_o\.(\w+)$')
+ORIGINAL_URL_TEMPLATE = 'https://live.staticflickr.com/{}/{}_{:010x}_o.{}'
+NO_VALUE = -1
+
+
+# The photos of an album, kept in columns rather than as an object for each
+# photo, so that accounts with millions of photos fit in memory. Names are
+# packed into one UTF-8 buffer, missing numbers are stored as NO_VALUE, and
+# original URLs are stored as the server and secret they are made of where
+# they follow the usual pattern. Photos are appended and read back as
+# PhotoDownloadSpec records.
+class PhotoList:
+    MEDIA = [None, 'photo', 'video']
+
+    def __init__(self, columns=None):
+        if columns is None:
+            columns = (bytearray(), array.array('I'), array.array('Q'), [], array.array('B'),
+                       array.array('I'), array.array('Q'), {}, array.array('q'),
+                       array.array('B'), array.array('q'), array.array('q'))
+        (self.names, self.name_ends, self.identifiers, self.filetypes, self.filetype_codes,
+         self.servers, self.secrets, self.other_urls, self.lastupdates, self.media,
+         self.pixels, self.dateuploads) = columns
+
+
+    def get_columns(self):
+        return (self.names, self.name_ends, self.identifiers, self.filetypes,
+                self.filetype_codes, self.servers, self.secrets, self.other_urls,
+                self.lastupdates, self.media, self.pixels, self.dateuploads)
+
+
+    def __len__(self):
+        return len(self.identifiers)
+
 
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
 
+
+    def append(self, photo):
+        idx = len(self)
+        self.names.extend((photo.name or '').encode('utf-8'))
+        self.name_ends.append(len(self.names))
+        self.identifiers.append(int(photo.identifier))
+        if photo.filetype not in self.filetypes:
+            self.filetypes.append(photo.filetype)
+        self.filetype_codes.append(self.filetypes.index(photo.filetype))
+        match = ORIGINAL_URL.match(photo.url) if photo.url is not None else None
+        if match is not None and match.group(2, 4) == (photo.identifier, photo.filetype):
+            self.servers.append(int(match.group(1)))
+            self.secrets.append(int(match.group(3), 16))
+        else:
+            self.servers.append(0)
+            self.secrets.append(0)
+            if photo.url is not None:
+                self.other_urls[idx] = photo.url
+        self.lastupdates.append(self.to_column(photo.lastupdate))
+        self.media.append(self.MEDIA.index(photo.media) if photo.media in self.MEDIA else 0)
+        self.pixels.append(self.to_column(photo.pixels))
+        self.dateuploads.append(self.to_column(photo.dateupload))
+
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start = self.name_ends[idx - 1] if idx > 0 else 0
+        name = self.names[start:self.name_ends[idx]].decode('utf-8')
+        identifier = str(self.identifiers[idx])
+        filetype = self.filetypes[self.filetype_codes[idx]]
+        if self.servers[idx]:
+            url = ORIGINAL_URL_TEMPLATE.format(self.servers[idx], identifier,
+                                               self.secrets[idx], filetype)
+        else:
+            url = self.other_urls.get(idx)
+        return PhotoDownloadSpec(name, identifier, filetype, url,
+                                 lastupdate=self.from_column(self.lastupdates[idx]),
+                                 media=self.MEDIA[self.media[idx]],
+                                 pixels=self.from_column(self.pixels[idx]),
+                                 dateupload=self.from_column(self.dateuploads[idx]))
+
+
+    @staticmethod
+    def to_column(value):
+        return value if value is not None else NO_VALUE
+
+
+    @staticmethod
+    def from_column(value):
+        return value if value != NO_VALUE else None
+
+
+# Looks up the original URL of photos whose listing didn't include it
+class UrlResolver:
+    def __init__(self, flickr, url_cache=None):
+        self.flickr = flickr
+        self.url_cache = url_cache
+
+
+    def get_url(self, photo):
+        if photo.url is not None:
+            return photo.url
+        url = None
+        if self.url_cache is not None:
+            url = self.url_cache.get(photo.identifier, photo.lastupdate).url
+        if url is None:
+            with metrics.phase('resolve_url'):
+                sizes = self.flickr.photos.getSizes(photo_id = photo.identifier)
+                url = sizes.findall('.//size[@label="Original"]')[0].get('source')
+            if self.url_cache is not None:
+                self.url_cache.put(photo.identifier, photo.lastupdate, url=url)
+        return url
+
+
+def format_bytes(num_bytes):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024
+    return '{:.1f} {}'.format(num_bytes, unit)
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+# Reserve space for the rest of the file up front, so that large files end up
+# less fragmented. Not all platforms and filesystems support this.
+def preallocate(f, offset, length):
+    if length <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    f.flush()
+    try:
+        os.posix_fallocate(f.fileno(), offset, length)
+    except OSError:
+        pass
+
+
+# Caps the total download rate, optionally only between two hours of the day
+class BandwidthLimit:
+    def __init__(self, rate, hours=None):
+        self.rate = rate
+        self.hours = hours
+        self.bucket = TokenBucket(rate, rate)
+
+
+    def is_active(self):
+        if self.hours is None:
+            return True
+        start, end = self.hours
+        hour = time.localtime().tm_hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+
+    def take(self, num_bytes):
+        if self.is_active():
+            self.bucket.take(num_bytes)
+
+
+# Downloads files over a pooled session, so that connections to the static
+# file hosts are kept alive and reused between photos.
+# With a limit given, how many files are downloaded at once adapts to how
+# quickly and reliably the static file hosts respond. See DownloadScheduler.
+class Downloader:
+    def __init__(self, pool_size=1, chunk_size=DOWNLOAD_CHUNK_SIZE, bandwidth=None, limit=None):
+        self.bandwidth = bandwidth
+        self.limit = limit
+        if bandwidth is not None:
+            # Small enough chunks that the rate stays even
+            chunk_size = min(chunk_size, max(bandwidth.rate // 10, 16 * 1024))
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+
+
+    # The file is written to partial_path and only renamed to path once it is
+    # complete. An existing partial file is resumed with an HTTP Range request
+    # if it was written from the same version of the file, such as the
+    # lastupdate of a photo, and downloaded again otherwise.
+    # Returns the size and SHA-256 digest of the file, and how long it took.
     @retry(NETWORK_EXCEPTIONS)
-    def get_url(self):
-        sizes = self._flickr.photos.getSizes(photo_id = self.identifier)
-        return sizes.findall('.//size[@label="Original"]')[0].get('source')
+    def download(self, url, path, partial_path, version=None):
+        start = time.monotonic()
+        try:
+            info = self._download(url, partial_path, version)
+        except NETWORK_EXCEPTIONS:
+            if self.limit is not None:
+                self.limit.failure()
+            raise
+        os.replace(partial_path, path)
+        info = info._replace(mtime=os.stat(path).st_mtime)
+        return info, time.monotonic() - start
+
+
+    def _download(self, url, partial_path, version=None):
+        offset = 0
+        if os.path.exists(partial_path):
+            # A partial file left by a failed download has the version it was
+            # written from as its modification time
+            if version is not None and int(os.path.getmtime(partial_path)) == version:
+                offset = os.path.getsize(partial_path)
+            else:
+                os.unlink(partial_path)
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+        with self.session.get(url, headers=headers, stream=True,
+                              timeout=DOWNLOAD_TIMEOUT) as response:
+            if offset > 0 and (response.status_code == 416 or response.status_code == 206 and
+                               get_range_start(response) != offset):
+                # Partial file is not a prefix of the file, start over
+                response.close()
+                os.unlink(partial_path)
+                return self._download(url, partial_path, version)
+            response.raise_for_status()
+            if self.limit is not None:
+                # Only the time to the response headers, as the rest depends
+                # on the size of the file
+                self.limit.success(response.elapsed.total_seconds())
+            if response.status_code != 206:
+                offset = 0
+            digest = hashlib.sha256()
+            size = offset
+            try:
+                with open(partial_path, 'r+b' if offset > 0 else 'wb') as f:
+                    if offset > 0:
+                        # Only the resumed part of the file is hashed as it streams in
+                        for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                            digest.update(chunk)
+                        f.seek(offset)
+                    length = response.headers.get('Content-Length')
+                    if length is not None and response.headers.get('Content-Encoding') is None:
+                        preallocate(f, offset, int(length))
+                    try:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            if self.cancelled.is_set():
+                                raise DownloadCancelled(partial_path)
+                            f.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                            with self.lock:
+                                self.bytes_downloaded += len(chunk)
+                            metrics.count('bytes_downloaded', len(chunk))
+                            if self.bandwidth is not None:
+                                self.bandwidth.take(len(chunk))
+                    finally:
+                        # Drop any preallocated space that wasn't written, so that
+                        # the size of a partial file is where to resume from
+                        f.truncate(size)
+            except BaseException:
+                if version is not None and os.path.exists(partial_path):
+                    os.utime(partial_path, (version, version))
+                raise
+        return filesystem.FileInfo(size, digest.hexdigest())
+
+
+    # Make running downloads stop at the next chunk, keeping their partial files
+    def cancel(self):
+        self.cancelled.set()
+
+
+    def get_rate(self):
+        return self.bytes_downloaded / max(time.monotonic() - self.started, 1e-6)
+
+
+    def close(self):
+        self.session.close()
+
+
+# Where the body of a 206 response starts in the file
+def get_range_start(response):
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match is not None else None
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+# Downloads are started in order of priority, lowest first. A policy gives
+# the priority of a photo from the photo and its position in the sync.
+def get_album_order_priority(photo, album_idx, photo_idx):
+    return (album_idx, photo_idx)
+
+
+# Small photos first, so that albums fill in quickly, and videos last
+def get_size_priority(photo, album_idx, photo_idx):
+    pixels = photo.pixels if photo.pixels is not None else math.inf
+    return (photo.media == 'video', pixels, album_idx, photo_idx)
+
+
+def get_newest_priority(photo, album_idx, photo_idx):
+    return (-(photo.dateupload or 0), album_idx, photo_idx)
+
+
+PRIORITY_POLICIES = {
+    'album': get_album_order_priority,
+    'size': get_size_priority,
+    'newest': get_newest_priority,
+}
+SCHEDULER_WINDOW = 1000
+PROGRESS_INTERVAL = 10
+
+
+# Runs downloads on a pool of worker threads. Of the downloads waiting, the
+# one with the lowest priority is started first, taken from the priority
+# attribute of the submitted function. Priorities are only compared between
+# the downloads queued at the same time, so the queue should be allowed to
+# hold a window of downloads. Progress is printed every PROGRESS_INTERVAL
+# seconds, with an ETA for the queued downloads based on their number, the
+# average size of the downloads so far and the download rate, and with the
+# current value of the given limits. If the downloader has a limit, no more
+# downloads than it allows are run at once.
+class DownloadScheduler(concurrent.futures.Executor):
+    def __init__(self, max_workers, downloader, limits=()):
+        self.downloader = downloader
+        self.limits = limits
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.last_progress = time.monotonic()
+        self.workers = [threading.Thread(target=self.work, daemon=True)
+                        for _ in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        priority = getattr(fn, 'priority', ())
+        self.queue.put((0, priority, next(self.sequence), future, fn, args, kwargs))
+        return future
+
+
+    def work(self):
+        limit = self.downloader.limit or contextlib.nullcontext()
+        while True:
+            # The download to start is only picked once it may start, so
+            # that it is the one with the lowest priority at that time
+            with limit:
+                entry = self.queue.get()
+                if entry[0] != 0:
+                    # Shut down
+                    return
+                _, _, _, future, fn, args, kwargs = entry
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            self.completed_one()
+
+
+    def completed_one(self):
+        with self.lock:
+            self.completed += 1
+            now = time.monotonic()
+            if now - self.last_progress < PROGRESS_INTERVAL:
+                return
+            self.last_progress = now
+        eta = self.get_eta()
+        print('Downloaded {} files ({}/s), {} queued, ETA {}'
+              .format(self.completed, format_bytes(self.downloader.get_rate()),
+                      self.queue.qsize(), format_duration(eta) if eta is not None else '?')
+              + ''.join(', {}'.format(limit) for limit in self.limits))
+
+
+    def get_eta(self):
+        rate = self.downloader.get_rate()
+        if self.completed == 0 or rate == 0:
+            return None
+        average_size = self.downloader.bytes_downloaded / self.completed
+        return self.queue.qsize() * average_size / rate
+
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if cancel_futures:
+            while True:
+                try:
+                    entry = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                # Like ThreadPoolExecutor, so that waiting for it returns
+                if entry[3].cancel():
+                    entry[3].set_running_or_notify_cancel()
+        for sequence in range(len(self.workers)):
+            self.queue.put((1, sequence))
+        if wait:
+            for worker in self.workers:
+                worker.join()
 
 
 def get_file_id(photoset_id, photo_id):
     return '{}-{}'.format(photoset_id, photo_id)
 
 
+def get_photoset_id(file_id):
+    return file_id.split('-', 1)[0]
+
+
+# Photosets are split between shards by their id, so that every instance
+# agrees on which shard a photoset belongs to. Shards are numbered from 1.
+def get_shard(photoset_id, num_shards):
+    return zlib.crc32(photoset_id.encode('utf-8')) % num_shards + 1
+
+
+def get_partition(shard):
+    return 'shard-{}-of-{}'.format(*shard) if shard is not None else None
+
+
+# Each shard keeps its own state and caches, named after the shard
+def get_shard_path(dirname, filename, shard=None):
+    if shard is not None:
+        root, ext = os.path.splitext(filename)
+        filename = '{}.{}{}'.format(root, get_partition(shard), ext)
+    return os.path.join(dirname, filename)
+
+
+LOCK_FILENAME = 'flickr-set-downloader.lock'
+LOCK_POLL_INTERVAL = 1
+LOCK_WAIT_TIMEOUT = 3600
+
+
+# The host and pid of the process holding a lock file, or None if it can't be told
+def get_lock_owner(path):
+    try:
+        with open(path) as f:
+            hostname, pid = f.read().split()
+        return hostname, int(pid)
+    except (OSError, ValueError):
+        return None
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# A lock file left behind by a process on this host that is no longer running
+# is taken over. It is moved out of the way first, so that of several
+# processes taking it over at once only one succeeds, and put back if another
+# process took the lock in the meantime.
+def remove_stale_lock(path):
+    owner = get_lock_owner(path)
+    if owner is None or owner[0] != socket.gethostname() or is_running(owner[1]):
+        return False
+    stale_path = '{}.stale.{}'.format(path, os.getpid())
+    try:
+        os.rename(path, stale_path)
+    except FileNotFoundError:
+        return True
+    if get_lock_owner(stale_path) != owner:
+        try:
+            os.link(stale_path, path)
+        except OSError:
+            pass
+        os.unlink(stale_path)
+        return False
+    os.unlink(stale_path)
+    print('Took over lock {} left behind by process {}, which is no longer running'
+          .format(path, owner[1]))
+    return True
+
+
+# Hold a lock file, so that two instances don't use the same state at once.
+# The lock file works across hosts sharing the working directory. With wait,
+# waits up to timeout seconds for the lock to be released.
+@contextlib.contextmanager
+def locked(path, wait=False, timeout=LOCK_WAIT_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    waiting = False
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if remove_stale_lock(path):
+                continue
+            owner = get_lock_owner(path)
+            held_by = ' by process {1} on {0}'.format(*owner) if owner is not None else ''
+            if not wait:
+                raise RuntimeError('{} is held{}, another instance may be running. '
+                                   'Remove it if that is not the case'.format(path, held_by))
+            if time.monotonic() > deadline:
+                raise RuntimeError('Gave up waiting for {} held{} after {}'
+                                   .format(path, held_by, format_duration(timeout)))
+            if not waiting:
+                print('Waiting for {} held{}'.format(path, held_by))
+                waiting = True
+            time.sleep(LOCK_POLL_INTERVAL)
+    try:
+        os.write(fd, '{} {}\n'.format(socket.gethostname(), os.getpid()).encode('utf-8'))
+        os.close(fd)
+        yield
+    finally:
+        os.unlink(path)
+
+
 def get_photo_filename(photo_name, filetype, idx, num_photos, photoset_title):
     width = math.floor(math.log10(num_photos)) + 2
     filename = '{idx:0{width}d} - {photo_name}.{suffix}'                                        \
@@ -81,17 +1170,350 @@ def get_photo_filename(photo_name, filetype, idx, num_photos, photoset_title):
     return os.path.join(photoset_title, filename)
 
 
-def get_download_spec(config):
-    flickr = flickrapi.FlickrAPI(config['api_key'], config['api_secret'],
-                                 username = config['username'])
-    download_spec = []
-    for photoset in flickr.walk_photosets():
-        download_spec.append(get_album_spec(flickr, photoset))
+ALBUM_CACHE_FILENAME = 'album-spec-cache.sqlite'
+OLD_ALBUM_CACHE_FILENAME = 'album-spec-cache.pickle'
+
+
+# Caches only save work, so a cache that can't be read, for example because a
+# run was killed while writing it, is started over instead of stopping the run
+def load_pickle(path, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        print("Ignoring {}, which can't be read: {}".format(path, first_line(str(e))))
+        return default
+
+
+# Written to a temporary file first, so that a run killed while saving leaves
+# the previous version in place
+def save_pickle(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+# Remembers the photos of each scanned photoset, keyed by the photoset's update
+# timestamp and photo count. Photosets that haven't changed since the last run
+# are served from the cache instead of being walked again.
+# Each photoset is a row of its own in an SQLite database, so that only the
+# photosets being synced are in memory and saving only writes those that
+# changed. The cache of older versions, a single pickle, is imported once.
+class AlbumSpecCache:
+    def __init__(self, dirname, shard=None):
+        self.path = get_shard_path(dirname, ALBUM_CACHE_FILENAME, shard)
+        # Used from the threads that scan photosets as well
+        self.lock = threading.Lock()
+        try:
+            self.db = self.connect()
+        except sqlite3.DatabaseError as e:
+            print("Ignoring {}, which can't be read: {}".format(self.path, e))
+            os.unlink(self.path)
+            self.db = self.connect()
+        old_path = get_shard_path(dirname, OLD_ALBUM_CACHE_FILENAME, shard)
+        if os.path.exists(old_path):
+            self.import_pickle(old_path)
+
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS albums (
+                    photoset_id TEXT PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    photo_ids BLOB NOT NULL,
+                    columns BLOB NOT NULL
+                )
+            ''')
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db
+
+
+    # Entries of the pickled cache are (key, columns of a PhotoList). Those
+    # written by even older versions, which kept a list of photos instead, are
+    # scanned again.
+    def import_pickle(self, path):
+        albums = load_pickle(path, {})
+        with self.lock:
+            for photoset_id, (key, columns) in albums.items():
+                if isinstance(columns, tuple):
+                    self.write(photoset_id, key, PhotoList(columns))
+            self.db.commit()
+        os.unlink(path)
+
+
+    def save(self):
+        with self.lock:
+            self.db.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+    @staticmethod
+    def get_key(photoset):
+        return (photoset.get('date_update'), photoset.get('photos'), photoset.get('videos'))
+
+
+    @staticmethod
+    def encode_key(key):
+        return json.dumps(list(key))
+
+
+    def get(self, photoset):
+        with self.lock:
+            row = self.db.execute('SELECT key, columns FROM albums WHERE photoset_id = ?',
+                                  (photoset.get('id'),)).fetchone()
+        if row is None or row[0] != self.encode_key(self.get_key(photoset)):
+            return None
+        return AlbumDownloadSpec(photoset.find('title').text.strip(), photoset.get('id'),
+                                 PhotoList(pickle.loads(row[1])))
+
+
+    def has_changed(self, photoset):
+        with self.lock:
+            row = self.db.execute('SELECT key FROM albums WHERE photoset_id = ?',
+                                  (photoset.get('id'),)).fetchone()
+        return row is None or row[0] != self.encode_key(self.get_key(photoset))
+
+
+    def put(self, photoset, album_spec):
+        with self.lock:
+            self.write(album_spec.identifier, self.get_key(photoset), album_spec.photos)
+
+
+    def write(self, photoset_id, key, photos):
+        self.db.execute('INSERT OR REPLACE INTO albums (photoset_id, key, photo_ids, columns) '
+                        'VALUES (?, ?, ?, ?)',
+                        (photoset_id, self.encode_key(key), photos.identifiers.tobytes(),
+                         pickle.dumps(photos.get_columns())))
+
+
+    def get_photoset_ids(self):
+        with self.lock:
+            return set(row[0] for row in self.db.execute('SELECT photoset_id FROM albums'))
+
+
+    def prune(self, photoset_ids):
+        gone = self.get_photoset_ids().difference(photoset_ids)
+        with self.lock:
+            self.db.executemany('DELETE FROM albums WHERE photoset_id = ?',
+                                ((photoset_id,) for photoset_id in gone))
+
+
+    # Drops the photosets that contain any of the photos, so that they are
+    # scanned again even though the photosets themselves haven't changed
+    def discard_photos(self, photo_ids):
+        photo_ids = set(int(photo_id) for photo_id in photo_ids)
+        discarded = []
+        with self.lock:
+            for photoset_id, identifiers in self.db.execute(
+                    'SELECT photoset_id, photo_ids FROM albums'):
+                if not photo_ids.isdisjoint(array.array('Q', identifiers)):
+                    discarded.append((photoset_id,))
+            self.db.executemany('DELETE FROM albums WHERE photoset_id = ?', discarded)
+
+
+URL_CACHE_FILENAME = 'url-cache.pickle'
+URL_CACHE_TTL = 30 * 24 * 3600
+URL_CACHE_SIZE = 200000
+
+
+# Original URLs and formats of photos, looked up when the photo listing
+# doesn't include them. An entry is used until it is ttl seconds old or the
+# photo has been updated since. Only the max_size most recently used entries
+# are kept.
+class UrlCache:
+    Entry = collections.namedtuple('Entry', ['lastupdate', 'timestamp', 'url', 'filetype'])
+    MISSING = Entry(None, None, None, None)
+
+    def __init__(self, dirname, shard=None, ttl=URL_CACHE_TTL, max_size=URL_CACHE_SIZE):
+        self.path = get_shard_path(dirname, URL_CACHE_FILENAME, shard)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict((photo_id, self.Entry(*entry))
+                                               for photo_id, entry in load_pickle(self.path, []))
+
+
+    def save(self):
+        with self.lock:
+            entries = [(photo_id, tuple(entry)) for photo_id, entry in self.entries.items()
+                       if not self.is_expired(entry)]
+        save_pickle(self.path, entries)
+
 
-    return download_spec
+    def is_expired(self, entry):
+        return time.time() - entry.timestamp > self.ttl
 
-@retry(NETWORK_EXCEPTIONS)
-def get_album_spec(flickr, photoset):
+
+    def get(self, photo_id, lastupdate):
+        with self.lock:
+            entry = self.entries.get(photo_id)
+            if entry is None:
+                metrics.count('url_cache_misses')
+                return self.MISSING
+            if entry.lastupdate != lastupdate or self.is_expired(entry):
+                self.entries.pop(photo_id)
+                metrics.count('url_cache_misses')
+                return self.MISSING
+            self.entries.move_to_end(photo_id)
+            metrics.count('url_cache_hits')
+            return entry
+
+
+    # Fields that aren't given are kept from the current entry, if it is still valid
+    def put(self, photo_id, lastupdate, url=None, filetype=None):
+        with self.lock:
+            entry = self.entries.pop(photo_id, None)
+            if entry is not None and entry.lastupdate == lastupdate and not self.is_expired(entry):
+                url = url or entry.url
+                filetype = filetype or entry.filetype
+                timestamp = entry.timestamp
+            else:
+                timestamp = time.time()
+            self.entries[photo_id] = self.Entry(lastupdate, timestamp, url, filetype)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+# A photoset is selected if its id or title matches one of the albums, which
+# may be glob patterns, it has been updated since the given timestamp and it
+# belongs to the given shard.
+def is_selected(photoset, albums=None, since=None, shard=None):
+    if shard is not None and get_shard(photoset.get('id'), shard[1]) != shard[0]:
+        return False
+    if albums:
+        photoset_id = photoset.get('id')
+        photoset_title = photoset.find('title').text.strip()
+        if not any(photoset_id == album or fnmatch.fnmatchcase(photoset_title, album)
+                   for album in albums):
+            return False
+    if since is not None and photoset.get('date_update') is not None:
+        if int(photoset.get('date_update')) < since:
+            return False
+    return True
+
+
+def get_flickr(config, scheduler=None):
+    return ScheduledFlickrAPI(config['api_key'], config['api_secret'],
+                              username = config['username'],
+                              scheduler = scheduler or ApiScheduler())
+
+
+# Photosets and updated photos are listed in as few calls as Flickr allows
+PER_PAGE = 500
+
+
+# Album specs are yielded as soon as each photoset has been scanned, so that
+# downloads can start before the whole account has been walked. Up to
+# scan_jobs photosets are scanned at the same time, but albums are always
+# yielded in the order of the photosets. Only photosets for which select
+# returns true are scanned, if it is given.
+def get_download_spec(config, cache=None, scheduler=None, scan_jobs=1, albums=None, since=None,
+                      url_cache=None, shard=None, flickr=None, select=None):
+    flickr = flickr or get_flickr(config, scheduler)
+    resolver = UrlResolver(flickr, url_cache)
+    photoset_ids = []
+
+    def scan(photoset):
+        album_spec = cache.get(photoset) if cache is not None else None
+        if album_spec is not None:
+            print("Photoset unchanged: {}".format(album_spec.name))
+        else:
+            with metrics.phase('scan'):
+                album_spec = get_album_spec(flickr, photoset, url_cache)
+            if cache is not None:
+                cache.put(photoset, album_spec)
+        album_spec.resolver = resolver
+        return album_spec
+
+    def photosets():
+        for photoset in flickr.walk_photosets(per_page=PER_PAGE):
+            photoset_ids.append(photoset.get('id'))
+            if is_selected(photoset, albums, since, shard) and (select is None or select(photoset)):
+                yield photoset
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=scan_jobs)
+    try:
+        yield from map_in_order(executor, scan, photosets(), 2 * scan_jobs)
+    finally:
+        # Scans queued ahead are dropped if the albums aren't all consumed
+        executor.shutdown(cancel_futures=True)
+    if cache is not None:
+        cache.prune(photoset_ids)
+
+
+BACKGROUND_POLL_INTERVAL = 0.1
+
+
+# Like executor.map, but only submits up to window items ahead of the one
+# being yielded instead of consuming the whole iterable up front.
+def map_in_order(executor, func, iterable, window):
+    futures = collections.deque()
+    for item in iterable:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+# Run a generator on a background thread, keeping at most maxsize items ready.
+# Exceptions raised by the generator are re-raised in the consuming thread.
+# Closing the returned generator stops the background thread at the next
+# item, and closes the generator it runs.
+def iterate_in_background(iterable, maxsize):
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    stopped = threading.Event()
+
+    # Returns False if the consumer has gone away
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=BACKGROUND_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+def get_album_spec(flickr, photoset, url_cache=None):
     photoset_id = photoset.get('id')
     photoset_title = photoset.find('title').text.strip()
     primary_photo = photoset.get('primary')
@@ -99,50 +1521,322 @@ def get_album_spec(flickr, photoset):
     album_spec = AlbumDownloadSpec(photoset_title, photoset_id)
     print("Scanning photoset: {}".format(photoset_title))
     logger.debug("album identifier is {}".format(photoset_id))
-    for photo in flickr.walk_set(photoset_id):
-        album_spec.photos.append(get_photo_spec(flickr, photo))
+    for photo in flickr.walk_set(photoset_id, per_page=PER_PAGE, extras=PHOTO_EXTRAS):
+        album_spec.photos.append(get_photo_spec(flickr, photo, url_cache))
     return album_spec
 
 
-@retry(NETWORK_EXCEPTIONS)
-def get_photo_spec(flickr, photo):
+# Asking photosets.getPhotos for these extras gives us everything we need to
+# download a photo straight from the page results.
+PHOTO_EXTRAS = 'original_format,url_o,last_update,media,o_dims,date_upload'
+
+
+def get_photo_spec(flickr, photo, url_cache=None):
     photo_id = photo.get('id')
     photo_name = photo.get('title')
+    lastupdate = photo.get('lastupdate')
     logger.debug("Found photo: {} - {}".format(photo_id, photo_name))
-    photo_info = flickr.photos.getInfo(photo_id = photo_id).getchildren()[0]
-    filetype = photo_info.get('originalformat')
-    return PhotoDownloadSpec(flickr, photo_name, photo_id, filetype)
-
-
-def download(working_directory, config):
-    download_spec = get_download_spec(config)
-    fs = filesystem.Filesystem(working_directory)
-    try:
-        for album in download_spec:
-            dirname = os.path.join(working_directory, album.name)
-            if not os.path.exists(dirname):
-                print ("Making directory {}".format(dirname))
-                os.mkdir(dirname)
-
-            num_photos = len(album.photos)
-            for idx, photo in enumerate(album.photos, 1):
-                filename = get_photo_filename(photo.name, photo.filetype, idx, num_photos, album.name)
-                file_identifier = get_file_id(album.identifier, photo.identifier)
-
-                @retry(NETWORK_EXCEPTIONS)
-                def download(url, path):
-                    urllib.request.urlretrieve(url, path)
-
-                def creator(path, try_num=0):
-                    print(" -- Downloading {}".format(path))
-                    download(photo.get_url(), path)
-                fs.add(file_identifier, filename, creator)
-        fs.finish_sync()
-    except KeyboardInterrupt:
-        pass
-    finally:
+    if lastupdate is not None:
+        lastupdate = int(lastupdate)
+    filetype = photo.get('originalformat')
+    if filetype is None and url_cache is not None:
+        filetype = url_cache.get(photo_id, lastupdate).filetype
+    if filetype is None:
+        # Extras missing from the page results, ask for each photo instead
+        filetype = get_original_format(flickr, photo_id)
+        if url_cache is not None:
+            url_cache.put(photo_id, lastupdate, filetype=filetype)
+    pixels = None
+    if photo.get('o_width') is not None and photo.get('o_height') is not None:
+        pixels = int(photo.get('o_width')) * int(photo.get('o_height'))
+    dateupload = int(photo.get('dateupload')) if photo.get('dateupload') is not None else None
+    return PhotoDownloadSpec(photo_name, photo_id, filetype,
+                             url=photo.get('url_o'), lastupdate=lastupdate,
+                             media=photo.get('media'), pixels=pixels, dateupload=dateupload)
+
+
+def get_original_format(flickr, photo_id):
+    photo_info = flickr.photos.getInfo(photo_id = photo_id).find('photo')
+    return photo_info.get('originalformat')
+
+
+# Times moving files around, cleaning up at the end of a sync and saving the
+# state. Adding files is only traced, as most of that time is spent waiting for
+# downloads to make room.
+class MeteredFilesystem(filesystem.Filesystem):
+    def add(self, identifier, filename, creator, content_id=None):
+        with tracer.span('add', 'filesystem', filename=filename):
+            return super().add(identifier, filename, creator, content_id)
+
+
+    def add_many(self, files):
+        with tracer.span('add_many', 'filesystem', files=len(files)):
+            return super().add_many(files)
+
+
+    def move_file(self, identifier, new_filename, temporary=False):
+        with metrics.phase('rename', filename=new_filename):
+            return super().move_file(identifier, new_filename, temporary)
+
+
+    def finish_sync(self, scope=None):
+        with metrics.phase('finish_sync'):
+            return super().finish_sync(scope)
+
+
+    def save(self):
+        with metrics.phase('save_state'):
+            return super().save()
+
+
+REPORT_FILENAME = 'run-report.json'
+SHARD_MANIFEST_FILENAME = 'shard-manifest.json'
+
+
+# Photos updated since the last poll are asked for with this much overlap, in
+# case our clock and Flickr's disagree
+WATCH_OVERLAP = 60
+
+
+# With shard given as (index, count), only the photosets of that shard are
+# synced, into a state of their own. See merge_shards().
+#
+# With watch given, changes are polled for every watch seconds after the first
+# sync, until interrupted. Only photosets that have been updated, and those
+# with photos that have been updated, are synced again on each poll.
+def download(working_directory, config, jobs=1, scan_jobs=1, scan_ahead=2,
+             state_backend='journal', api_calls_per_hour=FLICKR_CALLS_PER_HOUR,
+             report_path=None, prometheus_path=None, dedupe=True, verify=False,
+             albums=None, since=None, shard=None, priority='album', max_rate=None,
+             max_rate_hours=None, watch=None, max_jobs=None, max_api_jobs=None):
+    metrics.reset()
+    completed = False
+    album_cache = AlbumSpecCache(working_directory, shard)
+    url_cache = UrlCache(working_directory, shard)
+    # Given a maximum, concurrency adapts between one and the maximum, starting
+    # from the number of jobs
+    api_limit = AdaptiveLimit('API', scan_jobs, max_api_jobs) if max_api_jobs else None
+    download_limit = AdaptiveLimit('Download', jobs, max_jobs) if max_jobs else None
+    scan_jobs = max(scan_jobs, max_api_jobs or 0)
+    jobs = max(jobs, max_jobs or 0)
+    scheduler = ApiScheduler(calls_per_hour=api_calls_per_hour, limit=api_limit)
+    flickr = get_flickr(config, scheduler)
+    # Only files in the albums that are synced are removed when selecting albums
+    scope = [] if albums or since is not None or shard is not None else None
+    bandwidth = BandwidthLimit(max_rate, max_rate_hours) if max_rate else None
+    downloader = Downloader(pool_size=jobs, bandwidth=bandwidth, limit=download_limit)
+    limits = [limit for limit in [download_limit, api_limit] if limit is not None]
+    executor = DownloadScheduler(jobs, downloader, limits)
+    get_priority = PRIORITY_POLICIES[priority]
+    fs = MeteredFilesystem(working_directory, executor=executor,
+                           max_pending=max(SCHEDULER_WINDOW, 2 * jobs),
+                           backend=state_backend, partition=get_partition(shard))
+    if shard is not None:
+        start_shard(fs, working_directory, state_backend, shard)
+    # Directory of each photoset synced so far, to clean up after photosets
+    # that are deleted while watching
+    album_names = {}
+
+    # Scanning continues in the background while the albums already scanned are
+    # downloaded. Only scan_ahead albums are kept waiting, bounding memory use.
+    def sync(scope, select=None):
+        download_spec = iterate_in_background(
+            get_download_spec(config, album_cache, scheduler, scan_jobs, albums, since, url_cache,
+                              shard, flickr, select),
+            scan_ahead)
+        with contextlib.closing(download_spec):
+            for album_idx, album in enumerate(download_spec):
+                dirname = os.path.join(working_directory, album.name)
+                if not os.path.exists(dirname):
+                    print ("Making directory {}".format(dirname))
+                    os.mkdir(dirname)
+                if scope is not None:
+                    scope.append(album.name)
+                album_names[album.identifier] = album.name
+
+                num_photos = len(album.photos)
+                files = []
+                for idx, photo in enumerate(album.photos, 1):
+                    filename = get_photo_filename(photo.name, photo.filetype, idx, num_photos,
+                                                  album.name)
+                    file_identifier = get_file_id(album.identifier, photo.identifier)
+                    partial_path = fs.get_partial_path(file_identifier, filename)
+                    creator = get_photo_creator(downloader, album.resolver, photo, partial_path)
+                    creator.priority = get_priority(photo, album_idx, idx)
+                    # A photo in several albums is only downloaded once, the other
+                    # copies are linked to it
+                    files.append(filesystem.FileSpec(file_identifier, filename, creator,
+                                                     photo.identifier if dedupe else None))
+                fs.add_many(files)
+        if scope is not None:
+            # The album cache has been pruned of the photosets that are gone
+            for photoset_id in set(album_names).difference(album_cache.get_photoset_ids()):
+                scope.append(album_names.pop(photoset_id))
+        fs.finish_sync(scope)
+
+    def save():
         print('Saving filesystem state')
         fs.save()
+        album_cache.save()
+        url_cache.save()
+        files = {'files_{}'.format(name): value for name, value in fs.counters.items()}
+        concurrency = {'{}_concurrency_limit'.format(limit.name.lower()): limit.get_limit()
+                       for limit in limits}
+        metrics.write_report(report_path or get_shard_path(working_directory, REPORT_FILENAME, shard),
+                             completed=completed, files=dict(fs.counters), **concurrency)
+        if prometheus_path:
+            metrics.write_prometheus_textfile(prometheus_path, completed=int(completed),
+                                              **files, **concurrency)
+        if shard is not None and completed:
+            with open(get_shard_path(working_directory, SHARD_MANIFEST_FILENAME, shard), 'w') as f:
+                json.dump({'scope': scope, 'complete': not albums and since is None}, f)
+
+    try:
+        if verify:
+            verify_files(fs)
+        # While watching, a sync that fails is logged, and the next poll syncs
+        # all albums and asks for the updates since the last sync that succeeded
+        checkpoint = None
+        full_sync = True
+        # Updates seen by the last poll, which the overlap makes us see again
+        seen_updates = {}
+        while True:
+            started = int(time.time())
+            completed = False
+            updates = {}
+            try:
+                if checkpoint is not None:
+                    with metrics.phase('poll'):
+                        updates = {photo.get('id'): photo.get('lastupdate')
+                                   for photo in flickr.walk_user_updates(
+                                       checkpoint - WATCH_OVERLAP, per_page=PER_PAGE,
+                                       extras='last_update')}
+                        updated = [photo_id for photo_id, lastupdate in updates.items()
+                                   if seen_updates.get(photo_id) != lastupdate]
+                        album_cache.discard_photos(updated)
+                    print('{} photos updated since the last poll'.format(len(updated)))
+                sync_scope = None if full_sync and scope is None else []
+                sync(sync_scope, select=None if full_sync else album_cache.has_changed)
+            except Exception as e:
+                if watch is None:
+                    raise
+                metrics.count('failed_syncs')
+                print("Sync failed with '{}', syncing all albums at the next poll"
+                      .format(first_line(str(e))))
+                logger.debug('Sync failed', exc_info=True)
+                fs.abort_sync()
+                full_sync = True
+            else:
+                if scope is not None:
+                    scope.extend(name for name in sync_scope if name not in scope)
+                checkpoint = started
+                seen_updates = updates
+                full_sync = False
+                completed = True
+            if watch is None:
+                break
+            save()
+            print('Waiting {} for changes'.format(format_duration(watch)))
+            time.sleep(watch)
+    except KeyboardInterrupt:
+        downloader.cancel()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        downloader.close()
+        print('Downloaded {} ({}/s)'.format(format_bytes(downloader.bytes_downloaded),
+                                            format_bytes(downloader.get_rate())))
+        save()
+        album_cache.close()
+
+
+# Files that shards keep until they are merged: their states, manifests and
+# the locks of running shards. Their caches and reports are kept after merging.
+SHARD_FILE_PATTERN = re.compile(r'^(?:filesystem-state|shard-manifest|flickr-set-downloader)'
+                                r'\.shard-(\d+)-of-(\d+)\.(?:pickle|journal|sqlite|json|lock)$')
+
+
+# The shards that are running or have not been merged yet
+def get_active_shards(working_directory):
+    shards = set()
+    for name in os.listdir(working_directory):
+        match = SHARD_FILE_PATTERN.match(name)
+        if match:
+            shards.add((int(match.group(1)), int(match.group(2))))
+    return sorted(shards)
+
+
+def start_shard(fs, working_directory, state_backend, shard):
+    manifest_path = get_shard_path(working_directory, SHARD_MANIFEST_FILENAME, shard)
+    if os.path.exists(manifest_path):
+        os.unlink(manifest_path)
+    if fs.state.get_files():
+        return
+    # A new shard starts out with its part of the merged state
+    with locked(os.path.join(working_directory, LOCK_FILENAME), wait=True):
+        merged = filesystem.Filesystem(working_directory, backend=state_backend)
+        fs.import_files(merged.state,
+                        lambda file_id: get_shard(get_photoset_id(file_id), shard[1]) == shard[0])
+        merged.state.close()
+    print('Shard {}/{} starts with {} files'.format(*shard, len(fs.state.get_files())))
+
+
+# Once every shard has completed a sync, their states are merged into the
+# main state of the working directory. Files that no shard kept are deleted,
+# and the next run of each shard starts over from the merged state.
+def merge_shards(working_directory, num_shards, state_backend='journal'):
+    shards = [(index, num_shards) for index in range(1, num_shards + 1)]
+    manifests = []
+    for shard in shards:
+        manifest_path = get_shard_path(working_directory, SHARD_MANIFEST_FILENAME, shard)
+        if not os.path.exists(manifest_path):
+            raise RuntimeError('Shard {}/{} has not completed a sync since the last merge'
+                               .format(*shard))
+        with open(manifest_path) as f:
+            manifests.append(json.load(f))
+    scope = set().union(*(manifest['scope'] for manifest in manifests))
+    complete = all(manifest['complete'] for manifest in manifests)
+
+    fs = MeteredFilesystem(working_directory, backend=state_backend)
+    partitions = [filesystem.Filesystem(working_directory, backend=state_backend,
+                                        partition=get_partition(shard))
+                  for shard in shards]
+    with metrics.phase('merge'):
+        fs.merge(partitions, scope, complete)
+    fs.save()
+    for shard in shards:
+        os.unlink(get_shard_path(working_directory, SHARD_MANIFEST_FILENAME, shard))
+    print('Merged {} shards, deleted {} files'.format(num_shards, fs.counters['deleted']))
+
+
+def verify_files(fs):
+    print('Verifying downloaded files')
+    with metrics.phase('verify'):
+        # Forking now would copy the locks held by the threads of the
+        # download and API schedulers into the workers, where nothing
+        # releases them
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(mp_context=context) as executor:
+            corrupt = fs.verify(executor)
+    print('Verified files, {} missing or corrupt files will be downloaded again'
+          .format(len(corrupt)))
+    for identifier in corrupt:
+        logger.debug("Missing or corrupt: {}".format(identifier))
+
+
+# Creators may run on a worker thread after the loop in download() has moved
+# on, so each one must be bound to its own photo.
+def get_photo_creator(downloader, resolver, photo, partial_path):
+    def creator(path, try_num=0):
+        print(" -- Downloading {}".format(path))
+        url = resolver.get_url(photo)
+        with metrics.phase('download', path=path):
+            info, seconds = downloader.download(url, path, partial_path, photo.lastupdate)
+        logger.debug("Downloaded {} in {:.1f}s ({}/s)"
+                     .format(format_bytes(info.size), seconds,
+                             format_bytes(info.size / max(seconds, 1e-6))))
+        return info
+    return creator
+
 
 # Based on https://stackoverflow.com/a/11415816/265249
 class writable_dir(argparse.Action):
@@ -156,6 +1850,54 @@ class writable_dir(argparse.Action):
             raise argparse.ArgumentTypeError("{} is not a readable directory".format(prospective_dir))
 
 
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not a date like 2020-12-31".format(value))
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not a shard like 1/4".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("Shard {} is not between 1 and {}".format(index, count))
+    return index, count
+
+
+def parse_rate(value):
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    number, unit = value.rstrip('KMGkmg'), value[len(value.rstrip('KMGkmg')):].upper()
+    try:
+        return int(float(number) * units[unit])
+    except (ValueError, KeyError):
+        raise argparse.ArgumentTypeError("{} is not a rate like 500K or 2M".format(value))
+
+
+def parse_hours(value):
+    try:
+        start, end = (int(hour) for hour in value.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not a range of hours like 9-17".format(value))
+    if not (0 <= start < 24 and 0 <= end < 24):
+        raise argparse.ArgumentTypeError("Hours must be between 0 and 23")
+    return start, end
+
+
+def parse_interval(value):
+    units = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+    number, unit = value.rstrip('smh'), value[len(value.rstrip('smh')):]
+    try:
+        seconds = float(number) * units[unit]
+    except (ValueError, KeyError):
+        raise argparse.ArgumentTypeError("{} is not an interval like 90s, 5m or 1h".format(value))
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError("The interval must be positive")
+    return seconds
+
+
 def parse_arguments():
     helptext = \
 '''Flickr Photoset Backup and Downloader
@@ -192,6 +1934,64 @@ You can generate an API key here: https://www.flickr.com/services/apps/create/ap
                         help='Path to folder where photos should be stored')
     parser.add_argument('--debug', action='store_true',
                         help='Enable debugging output')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='Number of photos to download concurrently (default: 1)')
+    parser.add_argument('--scan-jobs', type=int, default=1, metavar='N',
+                        help='Number of photosets to scan concurrently (default: 1)')
+    parser.add_argument('--max-jobs', type=int, metavar='N',
+                        help='Adapt the number of concurrent downloads between 1 and N, starting '
+                             'from --jobs, backing off when downloads fail or slow down')
+    parser.add_argument('--max-api-jobs', type=int, metavar='N',
+                        help='Likewise adapt the number of concurrent API calls between 1 and N, '
+                             'starting from --scan-jobs')
+    parser.add_argument('--priority', choices=sorted(PRIORITY_POLICIES), default='album',
+                        help='Which photos to download first: in album order, smallest first '
+                             'with videos last, or newest first (default: album)')
+    parser.add_argument('--max-rate', type=parse_rate, metavar='RATE',
+                        help='Maximum total download rate in bytes per second, like 500K or 2M')
+    parser.add_argument('--max-rate-hours', type=parse_hours, metavar='START-END',
+                        help='Only limit the download rate between these hours of the day, '
+                             'like 9-17')
+    parser.add_argument('--state-backend', choices=sorted(filesystem.STATE_BACKENDS),
+                        default='journal',
+                        help='How to store the filesystem state (default: journal)')
+    parser.add_argument('--api-rate', type=int, default=FLICKR_CALLS_PER_HOUR, metavar='CALLS',
+                        help='Maximum number of Flickr API calls per hour (default: {})'
+                             .format(FLICKR_CALLS_PER_HOUR))
+    parser.add_argument('--no-dedupe', action='store_true',
+                        help='Download photos that are in several albums once for each album, '
+                             'instead of hardlinking the copies')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check downloaded files before syncing, and download missing or '
+                             'corrupt files again')
+    parser.add_argument('--album', action='append', dest='albums', metavar='ALBUM',
+                        help='Only sync the photoset with this id or title. Titles may contain '
+                             'wildcards like "Holiday *". Can be given several times. Files in '
+                             'the other photosets are left alone')
+    parser.add_argument('--since', type=parse_date, metavar='DATE',
+                        help='Only sync photosets updated since DATE (YYYY-MM-DD). Files in the '
+                             'other photosets are left alone')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help='Only sync shard I of N, letting N instances sync the same working '
+                             'directory. Photosets are split between shards by their id')
+    parser.add_argument('--merge-shards', type=int, metavar='N',
+                        help='Merge the state of N shards once each has completed a sync, and '
+                             'delete the files none of them kept')
+    parser.add_argument('--watch', type=parse_interval, metavar='INTERVAL',
+                        help='Keep running after the first sync, polling Flickr for updated '
+                             'photos and photosets every INTERVAL, like 5m, and only syncing '
+                             'the albums that changed')
+    parser.add_argument('--report', metavar='FILE',
+                        help='Where to write the JSON run report (default: {} in the working '
+                             'directory)'.format(REPORT_FILENAME))
+    parser.add_argument('--prometheus-textfile', metavar='FILE',
+                        help='Also write the run metrics to FILE in the Prometheus text format')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write spans of API calls, downloads and filesystem operations to '
+                             'FILE in the Chrome trace event format')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='Profile the run with cProfile, writing the stats of each phase '
+                             'to DIR')
     return parser.parse_args()
 
 
@@ -214,8 +2014,35 @@ def main():
     if args.debug:
         logger.setLevel(logging.DEBUG)
         logger.debug("Logger level set to debug")
+    if args.merge_shards:
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(traced(args.trace))
+            stack.enter_context(profiled(args.profile))
+            for shard in [None] + [(index, args.merge_shards)
+                                   for index in range(1, args.merge_shards + 1)]:
+                stack.enter_context(locked(get_shard_path(args.working_directory,
+                                                          LOCK_FILENAME, shard)))
+            merge_shards(args.working_directory, args.merge_shards, args.state_backend)
+        return
     config = parse_configuration(args.working_directory)
-    download(args.working_directory, config)
+    with locked(get_shard_path(args.working_directory, LOCK_FILENAME, args.shard)), \
+         traced(args.trace), profiled(args.profile, args.shard):
+        # The main state is only up to date once the shards are merged
+        active_shards = get_active_shards(args.working_directory) if args.shard is None else []
+        if active_shards:
+            raise RuntimeError('Shards {} are running or have not been merged, run with '
+                               '--merge-shards {} first'
+                               .format(', '.join(get_partition(shard) for shard in active_shards),
+                                       active_shards[0][1]))
+        download(args.working_directory, config, jobs=max(1, args.jobs),
+                 scan_jobs=max(1, args.scan_jobs),
+                 state_backend=args.state_backend, api_calls_per_hour=args.api_rate,
+                 report_path=args.report, prometheus_path=args.prometheus_textfile,
+                 dedupe=not args.no_dedupe, verify=args.verify,
+                 albums=args.albums, since=args.since, shard=args.shard,
+                 priority=args.priority, max_rate=args.max_rate,
+                 max_rate_hours=args.max_rate_hours, watch=args.watch,
+                 max_jobs=args.max_jobs, max_api_jobs=args.max_api_jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+import unittest
+import unittest.mock
+
+from test_photo_list import load_downloader
+
+downloader = load_downloader()
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = unittest.mock.patch('time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_slow_start(self):
+        limit = downloader.AdaptiveLimit('Download', 1, 10)
+        for expected in [2, 3, 4, 5]:
+            limit.success(0.1)
+            self.assertEqual(expected, limit.get_limit())
+
+    def test_additive_increase_after_decrease(self):
+        limit = downloader.AdaptiveLimit('Download', 8, 10)
+        limit.success(0.1)
+        limit.failure()
+        self.assertEqual(4.5, limit.limit)
+        self.assertFalse(limit.slow_start)
+        # Grows by 1 / limit for each success, about one for a limit's worth
+        limit.success(0.1)
+        self.assertAlmostEqual(4.5 + 1 / 4.5, limit.limit)
+        for _ in range(4):
+            limit.success(0.1)
+        self.assertEqual(5, limit.get_limit())
+
+    def test_one_decrease_per_latency(self):
+        limit = downloader.AdaptiveLimit('Download', 16, 16)
+        limit.success(0.5)
+        limit.failure()
+        self.assertEqual(8, limit.get_limit())
+        # Failures of downloads that ran at the same time only count once
+        self.now += 0.4
+        limit.failure()
+        self.assertEqual(8, limit.get_limit())
+        self.now += 0.2
+        limit.failure()
+        self.assertEqual(4, limit.get_limit())
+
+    def test_slow_responses(self):
+        limit = downloader.AdaptiveLimit('Download', 8, 16)
+        limit.success(0.1)
+        self.assertEqual(9, limit.get_limit())
+        # Up to SLOW_FACTOR times the average latency plus SLOW_MARGIN is fine
+        limit.success(0.1 * limit.SLOW_FACTOR + limit.SLOW_MARGIN - 0.01)
+        self.assertEqual(10, limit.get_limit())
+        limit.success(limit.latency * limit.SLOW_FACTOR + limit.SLOW_MARGIN + 0.01)
+        self.assertEqual(5, limit.get_limit())
+
+    def test_average_latency(self):
+        limit = downloader.AdaptiveLimit('Download', 1, 10)
+        self.assertIsNone(limit.latency)
+        limit.success(1.0)
+        self.assertEqual(1.0, limit.latency)
+        limit.success(2.0)
+        self.assertAlmostEqual(1.0 + limit.LATENCY_WEIGHT, limit.latency)
+
+    def test_bounds(self):
+        limit = downloader.AdaptiveLimit('Download', 5, 3, minimum=2)
+        self.assertEqual(3, limit.get_limit())
+        limit.success(0.1)
+        self.assertEqual(3, limit.get_limit())
+        for _ in range(3):
+            self.now += 1
+            limit.failure()
+        self.assertEqual(2, limit.get_limit())
+
+    def test_acquire_waits_for_release(self):
+        limit = downloader.AdaptiveLimit('Download', 1, 1)
+        limit.acquire()
+        acquired = threading.Event()
+        def acquire():
+            with limit:
+                acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        limit.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(0, limit.in_flight)
@@ -0,0 +1,199 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import email.utils
+import http.server
+import threading
+import time
+import unittest
+import unittest.mock
+
+import flickrapi
+import requests
+
+from test_photo_list import load_downloader
+
+downloader = load_downloader()
+
+
+class MockResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def http_error(retry_after=None):
+    headers = {'Retry-After': retry_after} if retry_after is not None else {}
+    return requests.exceptions.HTTPError('503 Server Error', response=MockResponse(headers))
+
+
+# Fails the first calls it is given, then returns 'ok'
+class FlakyCall:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = downloader.TokenBucket(rate=10, capacity=2)
+        with unittest.mock.patch('time.sleep') as sleep:
+            bucket.take()
+            bucket.take()
+            sleep.assert_not_called()
+            bucket.take()
+            self.assertEqual(1, sleep.call_count)
+            self.assertAlmostEqual(0.1, sleep.call_args[0][0], delta=0.01)
+            # Waiting callers reserve their tokens, so the next one waits longer
+            bucket.take()
+            self.assertAlmostEqual(0.2, sleep.call_args[0][0], delta=0.01)
+
+    def test_refill_up_to_capacity(self):
+        bucket = downloader.TokenBucket(rate=1000, capacity=2)
+        bucket.take(2)
+        time.sleep(0.05)
+        with unittest.mock.patch('time.sleep') as sleep:
+            bucket.take(2)
+            sleep.assert_not_called()
+            bucket.take()
+            self.assertEqual(1, sleep.call_count)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_threshold(self):
+        breaker = downloader.CircuitBreaker(threshold=3, cooldown=60)
+        breaker.failure()
+        breaker.failure()
+        with unittest.mock.patch('time.sleep') as sleep:
+            breaker.wait()
+            sleep.assert_not_called()
+            breaker.failure()
+            breaker.wait()
+            self.assertAlmostEqual(60, sleep.call_args[0][0], delta=1)
+
+    def test_success_resets(self):
+        breaker = downloader.CircuitBreaker(threshold=3, cooldown=60)
+        for _ in range(2):
+            breaker.failure()
+            breaker.failure()
+            breaker.success()
+        with unittest.mock.patch('time.sleep') as sleep:
+            breaker.wait()
+            sleep.assert_not_called()
+
+
+class TestGetRetryAfter(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(30, downloader.get_retry_after(http_error('30')))
+        self.assertEqual(0, downloader.get_retry_after(http_error('-5')))
+
+    def test_http_date(self):
+        retry_at = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertAlmostEqual(60, downloader.get_retry_after(http_error(retry_at)), delta=2)
+        retry_at = email.utils.formatdate(time.time() - 60, usegmt=True)
+        self.assertEqual(0, downloader.get_retry_after(http_error(retry_at)))
+
+    def test_missing_or_invalid(self):
+        self.assertEqual(0, downloader.get_retry_after(http_error()))
+        self.assertEqual(0, downloader.get_retry_after(http_error('soon')))
+        self.assertEqual(0, downloader.get_retry_after(ValueError()))
+
+    def test_retry_after_overrides_shorter_backoff(self):
+        self.assertEqual(30, downloader.get_retry_delay(http_error('30'), 0))
+        self.assertLessEqual(downloader.get_retry_delay(http_error(), 0),
+                             downloader.RETRY_BASE_DELAY)
+
+
+class TestApiScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = downloader.ApiScheduler(calls_per_hour=3600000)
+        patcher = unittest.mock.patch('time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_with_backoff(self):
+        call = FlakyCall(requests.exceptions.ConnectionError(), http_error())
+        self.assertEqual('ok', self.scheduler.call('test', call))
+        self.assertEqual(3, call.calls)
+        delays = [args[0] for args, _ in self.sleep.call_args_list]
+        self.assertEqual(2, len(delays))
+        self.assertLessEqual(delays[0], downloader.RETRY_BASE_DELAY)
+        self.assertLessEqual(delays[1], 2 * downloader.RETRY_BASE_DELAY)
+        self.assertEqual(0, self.scheduler.breaker.failures)
+
+    def test_honours_retry_after(self):
+        call = FlakyCall(http_error('30'))
+        self.assertEqual('ok', self.scheduler.call('test', call))
+        self.sleep.assert_called_once_with(30)
+
+    def test_gives_up_after_tries(self):
+        call = FlakyCall(*[requests.exceptions.Timeout() for _ in range(4)])
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.scheduler.call('test', call)
+        self.assertEqual(4, call.calls)
+        self.assertEqual(3, self.sleep.call_count)
+        self.assertEqual(4, self.scheduler.breaker.failures)
+
+    def test_permanent_errors_are_not_retried(self):
+        call = FlakyCall(flickrapi.exceptions.FlickrError('Error: 1: Photoset not found', code=1))
+        with self.assertRaises(flickrapi.exceptions.FlickrError):
+            self.scheduler.call('test', call)
+        self.assertEqual(1, call.calls)
+        self.sleep.assert_not_called()
+        self.assertEqual(0, self.scheduler.breaker.failures)
+
+    def test_transient_api_errors_are_retried(self):
+        call = FlakyCall(flickrapi.exceptions.FlickrError('Error: 105: Unavailable', code=105))
+        self.assertEqual('ok', self.scheduler.call('test', call))
+        self.assertEqual(2, call.calls)
+
+
+# Answers the first request with 429 and a Retry-After header, and the
+# others with an empty list of photosets
+class ThrottlingHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        if self.server.requests == 1:
+            body = b'Too many requests'
+            self.send_response(429)
+            self.send_header('Retry-After', '7')
+        else:
+            body = b'<?xml version="1.0" encoding="utf-8" ?>\n' \
+                   b'<rsp stat="ok"><photosets page="1" pages="1" total="0" /></rsp>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestScheduledFlickrAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_honours_retry_after_of_http_errors(self):
+        config = {'api_key': 'key', 'api_secret': 'secret', 'username': 'user'}
+        flickr = downloader.get_flickr(config, downloader.ApiScheduler(calls_per_hour=3600000))
+        flickr.REST_URL = 'http://127.0.0.1:{}/services/rest/'.format(self.server.server_port)
+        with unittest.mock.patch('time.sleep') as sleep:
+            flickr.photosets.getList()
+        sleep.assert_called_once_with(7)
+        self.assertEqual(2, self.server.requests)
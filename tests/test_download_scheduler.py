@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import concurrent.futures
+import threading
+import time
+import unittest
+
+from test_photo_list import load_downloader
+
+downloader = load_downloader()
+
+
+class MockDownloader:
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.bytes_downloaded = 0
+
+    def get_rate(self):
+        return 0
+
+
+def get_task(results, value, priority):
+    def task():
+        results.append(value)
+        return value
+    task.priority = priority
+    return task
+
+
+class TestDownloadScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    # Keeps the worker that runs it busy until released
+    def blocker(self):
+        self.started.set()
+        self.release.wait()
+
+    def test_priority_order(self):
+        scheduler = downloader.DownloadScheduler(1, MockDownloader())
+        scheduler.submit(self.blocker)
+        self.started.wait()
+        results = []
+        futures = [scheduler.submit(get_task(results, value, priority))
+                   for value, priority in [('c', (2, 0)), ('a', (1, 5)), ('d', (2, 0)),
+                                           ('b', (1, 7))]]
+        self.release.set()
+        self.assertEqual(['c', 'a', 'd', 'b'], [future.result(5) for future in futures])
+        # Lowest priority first, and in order of submission among equals
+        self.assertEqual(['a', 'b', 'c', 'd'], results)
+        scheduler.shutdown()
+
+    def test_errors_are_set_on_futures(self):
+        scheduler = downloader.DownloadScheduler(2, MockDownloader())
+        def fail():
+            raise IOError('download failed')
+        with self.assertRaises(IOError):
+            scheduler.submit(fail).result(5)
+        self.assertEqual(42, scheduler.submit(lambda: 42).result(5))
+        scheduler.shutdown()
+
+    def test_shutdown_cancels_queued_futures(self):
+        scheduler = downloader.DownloadScheduler(1, MockDownloader())
+        running = scheduler.submit(self.blocker)
+        self.started.wait()
+        results = []
+        queued = [scheduler.submit(get_task(results, value, ())) for value in range(3)]
+        scheduler.shutdown(wait=False, cancel_futures=True)
+
+        self.assertTrue(all(future.cancelled() for future in queued))
+        # Cancelled futures count as done, so waiting for them returns
+        done, not_done = concurrent.futures.wait(queued, timeout=5)
+        self.assertEqual(set(queued), done)
+        self.assertFalse(running.done())
+        self.release.set()
+        scheduler.shutdown()
+        self.assertTrue(running.done())
+        self.assertEqual([], results)
+        self.assertTrue(all(not worker.is_alive() for worker in scheduler.workers))
+
+    def test_shutdown_runs_queued_futures(self):
+        scheduler = downloader.DownloadScheduler(2, MockDownloader())
+        results = []
+        futures = [scheduler.submit(get_task(results, value, ())) for value in range(10)]
+        scheduler.shutdown()
+        self.assertEqual(list(range(10)), [future.result(0) for future in futures])
+        self.assertEqual(10, scheduler.completed)
+
+    def test_adaptive_limit(self):
+        limit = downloader.AdaptiveLimit('Download', 2, 2)
+        scheduler = downloader.DownloadScheduler(4, MockDownloader(limit), [limit])
+        lock = threading.Lock()
+        running = []
+        peak = []
+        def task():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+        futures = [scheduler.submit(task) for _ in range(12)]
+        concurrent.futures.wait(futures, timeout=5)
+        self.assertEqual(2, max(peak))
+
+        # Raising the limit lets the waiting workers start more at once
+        with limit.condition:
+            limit.maximum = 4
+            limit.set_limit(4)
+        peak.clear()
+        futures = [scheduler.submit(task) for _ in range(12)]
+        concurrent.futures.wait(futures, timeout=5)
+        self.assertEqual(4, max(peak))
+        scheduler.shutdown()
+        self.assertEqual(0, limit.in_flight)
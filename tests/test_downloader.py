@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import hashlib
+import os.path
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+import requests
+
+from test_photo_list import load_downloader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import fake_flickr
+
+downloader = load_downloader()
+
+VERSION = 1500000000
+PHOTO_SIZE = 300000
+
+
+# Ignores Range headers, answering with the whole file
+class NoRangeHandler(fake_flickr.FakeFlickrHandler):
+    def serve_photo(self, path):
+        del self.headers['Range']
+        super().serve_photo(path)
+
+
+# Answers a Range request with the file from its start
+class MisalignedRangeHandler(fake_flickr.FakeFlickrHandler):
+    def serve_photo(self, path):
+        if 'Range' in self.headers:
+            self.headers.replace_header('Range', 'bytes=0-')
+        super().serve_photo(path)
+
+
+# Sends the headers of the whole file, or of the range asked for, but only
+# half of it
+class DroppingHandler(fake_flickr.FakeFlickrHandler):
+    def write_throttled(self, body, chunk_size=64 * 1024):
+        self.wfile.write(body[:len(body) // 2])
+        self.server.bytes_sent += len(body) // 2
+        self.close_connection = True
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.account = fake_flickr.FakeAccount(1, 1, PHOTO_SIZE)
+        self.server = fake_flickr.FakeFlickrServer(self.account).start()
+        self.addCleanup(self.server.stop)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.photo_id = self.account.photosets[0]['photos'][0]
+        self.content = self.account.get_photo_content(self.photo_id)
+        self.url = '{}/static/{}_o.jpg'.format(self.server.url, self.photo_id)
+        self.path = os.path.join(self.tempdir.name, 'photo.jpg')
+        self.partial_path = os.path.join(self.tempdir.name, '.photo.part')
+        self.downloader = downloader.Downloader()
+        self.addCleanup(self.downloader.close)
+
+    def write_partial(self, content, version):
+        with open(self.partial_path, 'wb') as f:
+            f.write(content)
+        if version is not None:
+            os.utime(self.partial_path, (version, version))
+
+    def download(self, version=VERSION):
+        self.server.stats.reset()
+        info, _ = self.downloader.download(self.url, self.path, self.partial_path, version)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+        self.assertFalse(os.path.exists(self.partial_path))
+        self.assertEqual(len(self.content), info.size)
+        self.assertEqual(hashlib.sha256(self.content).hexdigest(), info.digest)
+        return self.server.stats.bytes_served
+
+    def test_download(self):
+        self.assertEqual(PHOTO_SIZE, self.download())
+
+    def test_resume_same_version(self):
+        self.write_partial(self.content[:1000], VERSION)
+        self.assertEqual(PHOTO_SIZE - 1000, self.download())
+
+    def test_partial_of_other_version(self):
+        self.write_partial(b'x' * 1000, VERSION - 1)
+        self.assertEqual(PHOTO_SIZE, self.download())
+
+    def test_partial_without_version(self):
+        self.write_partial(self.content[:1000], VERSION)
+        self.assertEqual(PHOTO_SIZE, self.download(version=None))
+
+    def test_partial_longer_than_file(self):
+        # The server answers 416 Range Not Satisfiable
+        self.write_partial(b'x' * (PHOTO_SIZE + 10), VERSION)
+        self.assertEqual(PHOTO_SIZE, self.download())
+
+    def test_range_starts_elsewhere(self):
+        self.server.RequestHandlerClass = MisalignedRangeHandler
+        self.write_partial(b'x' * 1000, VERSION)
+        self.assertEqual(PHOTO_SIZE * 2, self.download())
+
+    def test_range_ignored(self):
+        self.server.RequestHandlerClass = NoRangeHandler
+        self.write_partial(b'x' * 1000, VERSION)
+        self.assertEqual(PHOTO_SIZE, self.download())
+
+    def test_interrupted_download_is_truncated_and_resumed(self):
+        self.server.RequestHandlerClass = DroppingHandler
+        self.server.bytes_sent = 0
+        # Small enough chunks that what was received is written before the
+        # connection breaks
+        self.downloader.chunk_size = 1024
+        with unittest.mock.patch('time.sleep'):
+            with self.assertRaises(requests.exceptions.RequestException):
+                self.downloader.download(self.url, self.path, self.partial_path, VERSION)
+        # Each retry resumed the last, and the space preallocated for the rest
+        # of the file was dropped. Only the last chunk of each attempt, which
+        # was cut short, is lost.
+        with open(self.partial_path, 'rb') as f:
+            partial = f.read()
+        self.assertEqual(self.content[:len(partial)], partial)
+        self.assertGreater(len(partial), PHOTO_SIZE // 2)
+        self.assertLessEqual(len(partial), self.server.bytes_sent)
+        self.assertLess(self.server.bytes_sent, PHOTO_SIZE)
+        self.assertEqual(VERSION, int(os.path.getmtime(self.partial_path)))
+
+        self.server.RequestHandlerClass = fake_flickr.FakeFlickrHandler
+        self.assertEqual(PHOTO_SIZE - len(partial), self.download())
@@ -0,0 +1,46 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+import time
+import unittest
+
+from test_photo_list import load_downloader
+
+downloader = load_downloader()
+
+
+class TestIterateInBackground(unittest.TestCase):
+
+    def test_yields_in_order(self):
+        self.assertEqual(list(range(10)), list(downloader.iterate_in_background(range(10), 2)))
+
+    def test_reraises_errors(self):
+        def items():
+            yield 1
+            raise ValueError('scan failed')
+        iterator = downloader.iterate_in_background(items(), 2)
+        self.assertEqual(1, next(iterator))
+        with self.assertRaises(ValueError):
+            next(iterator)
+
+    def test_close_stops_producer(self):
+        closed = threading.Event()
+        def items():
+            try:
+                for item in range(1000):
+                    yield item
+            finally:
+                closed.set()
+        threads = threading.active_count()
+        iterator = downloader.iterate_in_background(items(), 2)
+        self.assertEqual(0, next(iterator))
+        # The producer is now blocked on a full queue
+        time.sleep(0.05)
+        iterator.close()
+
+        self.assertTrue(closed.wait(5))
+        deadline = time.monotonic() + 5
+        while threading.active_count() > threads and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(threads, threading.active_count())
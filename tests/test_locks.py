@@ -0,0 +1,129 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os.path
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+from test_photo_list import load_downloader
+
+downloader = load_downloader()
+
+
+# The pid of a process that has exited
+def get_dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+class TestLocks(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = os.path.join(self.tempdir.name, downloader.LOCK_FILENAME)
+
+    def write_lock(self, hostname, pid):
+        with open(self.path, 'w') as f:
+            f.write('{} {}\n'.format(hostname, pid))
+
+    def test_locked(self):
+        with downloader.locked(self.path):
+            self.assertEqual((socket.gethostname(), os.getpid()),
+                             downloader.get_lock_owner(self.path))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_held_lock(self):
+        with downloader.locked(self.path):
+            with self.assertRaisesRegex(RuntimeError, 'another instance may be running'):
+                with downloader.locked(self.path):
+                    pass
+            self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_wait_gives_up(self):
+        self.write_lock('otherhost', 1)
+        with unittest.mock.patch('time.sleep') as sleep:
+            with self.assertRaisesRegex(RuntimeError, 'Gave up waiting'):
+                with downloader.locked(self.path, wait=True, timeout=0.05):
+                    pass
+        sleep.assert_called_with(downloader.LOCK_POLL_INTERVAL)
+        self.assertEqual(('otherhost', 1), downloader.get_lock_owner(self.path))
+
+    def test_wait_for_release(self):
+        self.write_lock('otherhost', 1)
+        with unittest.mock.patch('time.sleep', lambda seconds: os.unlink(self.path)):
+            with downloader.locked(self.path, wait=True):
+                self.assertEqual(os.getpid(), downloader.get_lock_owner(self.path)[1])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_stale_lock_is_taken_over(self):
+        self.write_lock(socket.gethostname(), get_dead_pid())
+        self.assertTrue(downloader.remove_stale_lock(self.path))
+        self.assertEqual([], os.listdir(self.tempdir.name))
+
+        self.write_lock(socket.gethostname(), get_dead_pid())
+        with downloader.locked(self.path):
+            self.assertEqual(os.getpid(), downloader.get_lock_owner(self.path)[1])
+
+    def test_lock_of_running_process_is_kept(self):
+        self.write_lock(socket.gethostname(), os.getpid())
+        self.assertFalse(downloader.remove_stale_lock(self.path))
+        self.assertEqual([downloader.LOCK_FILENAME], os.listdir(self.tempdir.name))
+
+    def test_lock_of_other_host_is_kept(self):
+        self.write_lock('otherhost', get_dead_pid())
+        self.assertFalse(downloader.remove_stale_lock(self.path))
+        self.assertEqual([downloader.LOCK_FILENAME], os.listdir(self.tempdir.name))
+
+    def test_unreadable_lock_is_kept(self):
+        with open(self.path, 'w') as f:
+            f.write('garbage')
+        self.assertIsNone(downloader.get_lock_owner(self.path))
+        self.assertFalse(downloader.remove_stale_lock(self.path))
+        self.assertTrue(os.path.exists(self.path))
+
+
+class TestActiveShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def touch(self, filename, shard=None):
+        open(downloader.get_shard_path(self.tempdir.name, filename, shard), 'w').close()
+
+    def test_active_shards(self):
+        # The main state, and the caches and reports shards keep after merging
+        self.touch('filesystem-state.journal')
+        self.touch(downloader.LOCK_FILENAME)
+        self.touch(downloader.URL_CACHE_FILENAME, (1, 3))
+        self.touch('flickr-set-downloader.lock.stale.1234')
+        self.assertEqual([], downloader.get_active_shards(self.tempdir.name))
+
+        self.touch('filesystem-state.sqlite', (2, 3))
+        self.touch(downloader.SHARD_MANIFEST_FILENAME, (3, 3))
+        self.touch(downloader.SHARD_MANIFEST_FILENAME, (2, 3))
+        self.assertEqual([(2, 3), (3, 3)], downloader.get_active_shards(self.tempdir.name))
+
+    def test_running_shard(self):
+        with downloader.locked(downloader.get_shard_path(self.tempdir.name,
+                                                         downloader.LOCK_FILENAME, (1, 2))):
+            self.assertEqual([(1, 2)], downloader.get_active_shards(self.tempdir.name))
+        self.assertEqual([], downloader.get_active_shards(self.tempdir.name))
+
+    def test_unsharded_run_is_refused(self):
+        self.touch('filesystem-state.journal', (1, 2))
+        arguments = ['flickr-set-downloader.py', self.tempdir.name]
+        with unittest.mock.patch.object(sys, 'argv', arguments), \
+             unittest.mock.patch.object(downloader, 'parse_configuration'), \
+             unittest.mock.patch.object(downloader, 'download') as download:
+            with self.assertRaisesRegex(RuntimeError, '--merge-shards 2'):
+                downloader.main()
+        download.assert_not_called()
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, downloader.LOCK_FILENAME)))
@@ -0,0 +1,176 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import importlib.util
+import os.path
+import pickle
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+_dirname = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, _dirname)
+
+
+def load_downloader():
+    path = os.path.join(_dirname, 'flickr-set-downloader.py')
+    spec = importlib.util.spec_from_file_location('flickr_set_downloader', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+downloader = load_downloader()
+Spec = downloader.PhotoDownloadSpec
+
+
+class TestPhotoList(unittest.TestCase):
+
+    def assertRoundTrip(self, photos):
+        photo_list = downloader.PhotoList()
+        for photo in photos:
+            photo_list.append(photo)
+        # Also through the columns, as they are kept in the album cache
+        columns = pickle.loads(pickle.dumps(photo_list.get_columns()))
+        for result in [list(photo_list), list(downloader.PhotoList(columns))]:
+            self.assertEqual(len(result), len(photos))
+            for photo, copy in zip(photos, result):
+                for attr in Spec.__slots__:
+                    self.assertEqual(getattr(copy, attr), getattr(photo, attr), attr)
+
+    def test_standard_url(self):
+        url = 'https://live.staticflickr.com/65535/51234567890_0123456789_o.jpg'
+        photo_list = downloader.PhotoList()
+        photo_list.append(Spec('Photo', '51234567890', 'jpg', url, lastupdate=1600000000,
+                               media='photo', pixels=12000000, dateupload=1500000000))
+        self.assertEqual(photo_list.other_urls, {})
+        self.assertEqual(photo_list[0].url, url)
+
+    def test_non_standard_urls(self):
+        self.assertRoundTrip([
+            # Another host, another photo, another format and a secret that
+            # doesn't fit the pattern are kept as they are
+            Spec('Other host', '1', 'jpg', 'http://127.0.0.1:8000/static/1_o.jpg'),
+            Spec('Other photo', '2', 'jpg',
+                 'https://live.staticflickr.com/65535/3_0123456789_o.jpg'),
+            Spec('Other format', '4', 'png',
+                 'https://live.staticflickr.com/65535/4_0123456789_o.jpg'),
+            Spec('Short secret', '5', 'jpg', 'https://live.staticflickr.com/65535/5_0123_o.jpg'),
+            Spec('Leading zeros', '6', 'jpg',
+                 'https://live.staticflickr.com/65535/6_000000abcd_o.jpg'),
+            Spec('No url', '7', 'jpg'),
+        ])
+
+    def test_non_ascii_names(self):
+        self.assertRoundTrip([
+            Spec('Blåbærsyltetøy', '1', 'jpg'),
+            Spec('', '2', 'jpg'),
+            Spec('日本語のタイトル', '3', 'jpg'),
+            Spec('Emoji 📷', '4', 'jpg'),
+        ])
+
+    def test_missing_values(self):
+        self.assertRoundTrip([
+            Spec('All', '1', 'mp4', lastupdate=1600000000, media='video', pixels=2073600,
+                 dateupload=1500000000),
+            Spec('None', '2', 'jpg'),
+            # Values that happen to be zero aren't missing
+            Spec('Zeros', '3', 'jpg', lastupdate=0, pixels=0, dateupload=0),
+        ])
+
+    def test_missing_value_is_not_stored_as_is(self):
+        photo_list = downloader.PhotoList()
+        photo_list.append(Spec('Photo', '1', 'jpg'))
+        self.assertEqual(photo_list.lastupdates[0], downloader.NO_VALUE)
+        self.assertIsNone(photo_list[0].lastupdate)
+
+    def test_index_out_of_range(self):
+        photo_list = downloader.PhotoList()
+        photo_list.append(Spec('Photo', '1', 'jpg'))
+        self.assertEqual(photo_list[0].identifier, '1')
+        with self.assertRaises(IndexError):
+            photo_list[1]
+        with self.assertRaises(IndexError):
+            photo_list[-1]
+
+
+class TestAlbumSpecCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.photoset = ElementTree.fromstring(
+            '<photoset id="72157600000000000" date_update="1500000000" photos="1" videos="0">'
+            '<title>Album</title></photoset>')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_round_trip(self):
+        photos = downloader.PhotoList()
+        photos.append(Spec('Åpen dør', '1', 'jpg', lastupdate=1600000000, media='photo'))
+        cache = downloader.AlbumSpecCache(self.tempdir.name)
+        cache.put(self.photoset, downloader.AlbumDownloadSpec('Album', '72157600000000000',
+                                                              photos))
+        cache.save()
+
+        album = downloader.AlbumSpecCache(self.tempdir.name).get(self.photoset)
+        self.assertEqual(album.name, 'Album')
+        self.assertEqual([(photo.name, photo.identifier, photo.lastupdate, photo.media)
+                          for photo in album.photos],
+                         [('Åpen dør', '1', 1600000000, 'photo')])
+
+    def test_discard_photos(self):
+        cache = downloader.AlbumSpecCache(self.tempdir.name)
+        for photoset_id, photo_id in [('1', '10'), ('2', '20')]:
+            photos = downloader.PhotoList()
+            photos.append(Spec('Photo', photo_id, 'jpg'))
+            cache.put(self.photoset, downloader.AlbumDownloadSpec('Album', photoset_id, photos))
+        cache.discard_photos(['20', '30'])
+        self.assertEqual({'1'}, cache.get_photoset_ids())
+        cache.prune(['2'])
+        self.assertEqual(set(), cache.get_photoset_ids())
+
+    def test_changed_photoset(self):
+        cache = downloader.AlbumSpecCache(self.tempdir.name)
+        cache.put(self.photoset, downloader.AlbumDownloadSpec('Album', '72157600000000000'))
+        self.assertFalse(cache.has_changed(self.photoset))
+        self.photoset.set('date_update', '1600000000')
+        self.assertTrue(cache.has_changed(self.photoset))
+        self.assertIsNone(cache.get(self.photoset))
+
+    def test_old_entries_are_scanned_again(self):
+        # Older versions kept a list of tuples for each album
+        key = downloader.AlbumSpecCache.get_key(self.photoset)
+        photo = ('Photo', '1', 'jpg', None, 1600000000, 'photo', None, None)
+        path = os.path.join(self.tempdir.name, downloader.OLD_ALBUM_CACHE_FILENAME)
+        with open(path, 'wb') as f:
+            pickle.dump({'72157600000000000': (key, [photo])}, f)
+
+        cache = downloader.AlbumSpecCache(self.tempdir.name)
+        self.assertIsNone(cache.get(self.photoset))
+        self.assertTrue(cache.has_changed(self.photoset))
+        self.assertEqual(set(), cache.get_photoset_ids())
+        self.assertFalse(os.path.exists(path))
+
+    def test_pickled_cache_is_imported(self):
+        photos = downloader.PhotoList()
+        photos.append(Spec('Photo', '1', 'jpg', lastupdate=1600000000))
+        key = downloader.AlbumSpecCache.get_key(self.photoset)
+        path = os.path.join(self.tempdir.name, downloader.OLD_ALBUM_CACHE_FILENAME)
+        with open(path, 'wb') as f:
+            pickle.dump({'72157600000000000': (key, photos.get_columns())}, f)
+
+        album = downloader.AlbumSpecCache(self.tempdir.name).get(self.photoset)
+        self.assertEqual([('Photo', 1600000000)],
+                         [(photo.name, photo.lastupdate) for photo in album.photos])
+
+    def test_unreadable_cache_is_ignored(self):
+        for filename in [downloader.ALBUM_CACHE_FILENAME, downloader.OLD_ALBUM_CACHE_FILENAME]:
+            with open(os.path.join(self.tempdir.name, filename), 'wb') as f:
+                f.write(b'\x80\x04\x95 truncated')
+        cache = downloader.AlbumSpecCache(self.tempdir.name)
+        self.assertIsNone(cache.get(self.photoset))
+        cache.put(self.photoset, downloader.AlbumDownloadSpec('Album', '72157600000000000'))
+        cache.save()
+        self.assertIsNotNone(downloader.AlbumSpecCache(self.tempdir.name).get(self.photoset))
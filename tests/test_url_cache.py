@@ -0,0 +1,45 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import os.path
+import tempfile
+import unittest
+
+from test_photo_list import load_downloader
+
+downloader = load_downloader()
+
+
+class TestUrlCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, downloader.URL_CACHE_FILENAME)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_round_trip(self):
+        cache = downloader.UrlCache(self.tempdir.name)
+        cache.put('1', 1600000000, url='https://example.com/1_o.jpg', filetype='jpg')
+        cache.save()
+
+        cache = downloader.UrlCache(self.tempdir.name)
+        self.assertEqual('https://example.com/1_o.jpg', cache.get('1', 1600000000).url)
+        self.assertIsNone(cache.get('1', 1700000000).url)
+        self.assertEqual([downloader.URL_CACHE_FILENAME], os.listdir(self.tempdir.name))
+
+    def test_unreadable_cache_is_ignored(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x80\x04\x95 truncated')
+        cache = downloader.UrlCache(self.tempdir.name)
+        self.assertIsNone(cache.get('1', 1600000000).url)
+        cache.put('1', 1600000000, url='https://example.com/1_o.jpg')
+        cache.save()
+        self.assertIsNotNone(downloader.UrlCache(self.tempdir.name).get('1', 1600000000).url)
+
+    def test_expired_entries_are_not_saved(self):
+        cache = downloader.UrlCache(self.tempdir.name, ttl=-1)
+        cache.put('1', 1600000000, url='https://example.com/1_o.jpg')
+        cache.save()
+        self.assertEqual(0, len(downloader.UrlCache(self.tempdir.name).entries))